@@ -5,13 +5,24 @@ from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 
-from config import CLICKHOUSE_DATABASE
+from config import (
+    CLEAN_MAX_IN_FLIGHT,
+    CLICKHOUSE_DATABASE,
+    DEDUP_PROCESSES,
+    DEDUP_WORKERS,
+    IMPORT_WORKERS,
+    NEAR_DUP_NUM_PERM,
+    NEAR_DUP_THRESHOLD,
+)
 from infra import get_clickhouse_client
 from pipeline import (
+    ImportFilter,
     clean_email_bodies_from_db,
     deduplicate_emails,
     import_mbox_to_clickhouse,
+    import_pst_to_clickhouse,
     index_messages,
+    near_dedup_emails,
     parse_emails_from_db,
 )
 from retrieval import (
@@ -36,11 +47,32 @@ SQL_DIR = Path(__file__).parent / "sql"
 
 class ImportRequest(BaseModel):
     max_emails: int = 0
+    workers: int = IMPORT_WORKERS
+    resume: bool = True
+    header_filter: ImportFilter | None = None
+
+
+class ImportPstRequest(BaseModel):
+    max_emails: int = 0
+    workers: int = IMPORT_WORKERS
+    resume: bool = True
+
+
+class DedupRequest(BaseModel):
+    workers: int = DEDUP_WORKERS
+    full: bool = False
+    processes: int = DEDUP_PROCESSES
+
+
+class NearDedupRequest(BaseModel):
+    threshold: float = NEAR_DUP_THRESHOLD
+    num_perm: int = NEAR_DUP_NUM_PERM
 
 
 class CleanBodiesRequest(BaseModel):
     fetch_batch: int = 30
     llm_batch: int = 5
+    max_in_flight: int = CLEAN_MAX_IN_FLIGHT
 
 
 class ParseRequest(BaseModel):
@@ -102,21 +134,45 @@ def api_init_db():
 
 @app.post("/pipeline/import-mbox")
 def api_import_mbox(payload: ImportRequest):
-    import_mbox_to_clickhouse(max_emails=payload.max_emails)
+    import_mbox_to_clickhouse(
+        max_emails=payload.max_emails,
+        workers=payload.workers,
+        resume=payload.resume,
+        header_filter=payload.header_filter,
+    )
+    return {"status": "ok"}
+
+
+@app.post("/pipeline/import-pst")
+def api_import_pst(payload: ImportPstRequest):
+    import_pst_to_clickhouse(
+        max_emails=payload.max_emails,
+        workers=payload.workers,
+        resume=payload.resume,
+    )
     return {"status": "ok"}
 
 
 @app.post("/pipeline/dedup")
-def api_dedup():
-    deduplicate_emails()
+def api_dedup(payload: DedupRequest | None = None):
+    payload = payload or DedupRequest()
+    deduplicate_emails(workers=payload.workers, full=payload.full, processes=payload.processes)
     return {"status": "ok"}
 
 
+@app.post("/pipeline/near-dedup")
+def api_near_dedup(payload: NearDedupRequest | None = None):
+    payload = payload or NearDedupRequest()
+    report = near_dedup_emails(threshold=payload.threshold, num_perm=payload.num_perm)
+    return {"status": "ok", "report": report}
+
+
 @app.post("/pipeline/clean-bodies")
 def api_clean_bodies(payload: CleanBodiesRequest):
     clean_email_bodies_from_db(
         fetch_batch=payload.fetch_batch,
         llm_batch=payload.llm_batch,
+        max_in_flight=payload.max_in_flight,
     )
     return {"status": "ok"}
 
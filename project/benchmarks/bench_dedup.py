@@ -0,0 +1,191 @@
+"""dedup_thread benchmark: containment index vs the original pairwise scan.
+
+Pathological threads: a long "weekly status" thread where every reply
+quotes the whole history (each body contains all shorter ones), a thread
+of distinct bodies sharing signatures and disclaimers (nothing is
+contained, so the old scan compares every pair), and a mix of both.
+
+--engine-threads N also times a chunk of N threads of mixed sizes through
+groupby + dedup_thread (the old per-thread DataFrame loop) and through
+dedup_frame, inline and sharded over a --processes pool.
+
+Run from project/:
+    python -m benchmarks.bench_dedup --messages 2000
+    python -m benchmarks.bench_dedup --no-reference --engine-threads 2000 --processes 8
+"""
+import argparse
+import json
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+from pipeline import dedup_frame, dedup_thread
+
+SIGNATURE = "\n--\nBest regards,\nProject office\nThis e-mail may contain confidential information.\n"
+WORDS = "status risk milestone budget delivery vendor review action owner blocked done".split()
+
+
+def dedup_thread_reference(df_thread):
+    """The original O(n^2) implementation, kept as the reference output."""
+    rows = df_thread.sort_values(
+        by="body_text",
+        key=lambda x: x.str.len(),
+        ascending=False
+    )
+
+    kept = []
+
+    for _, row in rows.iterrows():
+        body = row["body_text"]
+        duplicate = False
+
+        for k in kept:
+            if body in k["body_text"]:
+                duplicate = True
+                break
+
+        if not duplicate:
+            kept.append(row)
+
+    return pd.DataFrame(kept)
+
+
+def _update(rng: random.Random, i: int) -> str:
+    lines = [f"Week {i}: " + " ".join(rng.choice(WORDS) for _ in range(8)) for _ in range(rng.randint(2, 6))]
+    return "\n".join(lines)
+
+
+def quoted_history_thread(n: int, rng: random.Random, max_quoted: int = 32 * 1024) -> list[str]:
+    # Replies quote the previous mail (and so the whole history) up to
+    # max_quoted characters, like clients that trim very long quotes.
+    bodies = []
+    history = ""
+    for i in range(n):
+        body = _update(rng, i) + SIGNATURE
+        if history:
+            body += "\n-----Original Message-----\n" + history[:max_quoted]
+        history = body
+        bodies.append(body)
+    return bodies
+
+
+def distinct_thread(n: int, rng: random.Random) -> list[str]:
+    return [_update(rng, i) + SIGNATURE for i in range(n)]
+
+
+def mixed_thread(n: int, rng: random.Random) -> list[str]:
+    bodies = quoted_history_thread(n // 2, rng) + distinct_thread(n - n // 2, rng)
+    # exact repeats and one-liners exercise the short-body fallback
+    bodies += rng.sample(bodies, k=max(1, n // 20)) + ["ok", "thanks!", ""]
+    rng.shuffle(bodies)
+    return bodies
+
+
+THREADS = {
+    "quoted_history": quoted_history_thread,
+    "distinct": distinct_thread,
+    "mixed": mixed_thread,
+}
+
+
+def to_frame(bodies: list[str]) -> pd.DataFrame:
+    start = datetime(2024, 1, 1)
+    return pd.DataFrame({
+        "id": [f"id{i}" for i in range(len(bodies))],
+        "thread_key": "weekly status",
+        "sent_at_utc": [start + timedelta(hours=i) for i in range(len(bodies))],
+        "from_addr": [[f"user{i % 7}@example.com"] for i in range(len(bodies))],
+        "body_text": bodies,
+    })
+
+
+def timed(fn, df: pd.DataFrame) -> tuple[float, pd.DataFrame]:
+    started = time.perf_counter()
+    out = fn(df)
+    return time.perf_counter() - started, out
+
+
+def run(messages: int, seed: int = 1, reference: bool = True) -> dict:
+    report = {}
+    for name, make in THREADS.items():
+        df = to_frame(make(messages, random.Random(seed)))
+        new_seconds, new = timed(dedup_thread, df)
+        result = {
+            "messages": len(df),
+            "mb": round(df["body_text"].str.len().sum() / (1024 * 1024), 2),
+            "kept": len(new),
+            "index_seconds": round(new_seconds, 3),
+        }
+        if reference:
+            old_seconds, old = timed(dedup_thread_reference, df)
+            result["reference_seconds"] = round(old_seconds, 3)
+            result["speedup"] = round(old_seconds / max(new_seconds, 1e-9), 1)
+            result["identical"] = list(old["id"]) == list(new["id"])
+        report[name] = result
+    return report
+
+
+def engine_frame(threads: int, seed: int = 1, max_messages: int = 60) -> pd.DataFrame:
+    rng = random.Random(seed)
+    frames = []
+    for t in range(threads):
+        make = mixed_thread if t % 2 else distinct_thread
+        frame = to_frame(make(rng.randint(1, max_messages), rng))
+        frame["thread_key"] = f"thread {t:06d}"
+        frame["id"] = f"t{t}-" + frame["id"]
+        frames.append(frame)
+    return pd.concat(frames, ignore_index=True)
+
+
+def run_engine(threads: int, processes: int, seed: int = 1) -> dict:
+    df = engine_frame(threads, seed)
+
+    started = time.perf_counter()
+    old = pd.concat([dedup_thread(g) for _, g in df.groupby("thread_key")])
+    old_seconds = time.perf_counter() - started
+
+    inline_seconds, inline = timed(dedup_frame, df)
+
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        pool.submit(int).result()  # start the workers outside the timing
+        pool_seconds, pooled = timed(lambda d: dedup_frame(d, pool, processes), df)
+
+    def kept_bodies(rows):
+        return set(zip(rows["thread_key"], rows["body_text"]))
+
+    return {
+        "threads": threads,
+        "messages": len(df),
+        "mb": round(df["body_text"].str.len().sum() / (1024 * 1024), 2),
+        "kept": len(inline),
+        "groupby_seconds": round(old_seconds, 3),
+        "packed_seconds": round(inline_seconds, 3),
+        "pool_seconds": round(pool_seconds, 3),
+        "processes": processes,
+        # exact repeats may keep a different (equal) copy, so compare bodies
+        "identical": kept_bodies(old) == kept_bodies(df.take(inline))
+        and np.array_equal(inline, pooled),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--no-reference", action="store_true", help="skip the slow O(n^2) reference run")
+    parser.add_argument("--engine-threads", type=int, default=0)
+    parser.add_argument("--processes", type=int, default=4)
+    args = parser.parse_args()
+
+    report = run(args.messages, args.seed, not args.no_reference)
+    if args.engine_threads:
+        report["engine"] = run_engine(args.engine_threads, args.processes, args.seed)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""HTML-to-text micro-benchmark: html_to_text vs BeautifulSoup(..., "lxml").get_text("\n").
+
+Run from project/:
+    python -m benchmarks.bench_html_to_text --dir path/to/html_bodies
+    python -m benchmarks.bench_html_to_text --clickhouse 5000
+"""
+import argparse
+import json
+import time
+from pathlib import Path
+
+from bs4 import BeautifulSoup
+
+from infra import get_clickhouse_client
+from pipeline import html_to_text
+
+
+def load_dir(path: str) -> list[str]:
+    bodies = []
+    for fp in sorted(Path(path).rglob("*.htm*")):
+        bodies.append(fp.read_text(encoding="utf-8", errors="ignore"))
+    return bodies
+
+
+def load_clickhouse(limit: int) -> list[str]:
+    client = get_clickhouse_client()
+    rows = client.query(
+        """
+        SELECT body_html
+        FROM mailkb.emails
+        WHERE body_html != ''
+        LIMIT %(limit)s
+        """,
+        {"limit": limit},
+    ).result_rows
+    return [r[0] for r in rows]
+
+
+def bs4_text(html: str) -> str:
+    return BeautifulSoup(html, "lxml").get_text("\n")
+
+
+def timed(fn, bodies: list[str], repeat: int) -> tuple[float, list[str]]:
+    best = float("inf")
+    out = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        out = [fn(b) for b in bodies]
+        best = min(best, time.perf_counter() - start)
+    return best, out
+
+
+def run(bodies: list[str], repeat: int = 3) -> dict:
+    mbytes = sum(len(b) for b in bodies) / (1024 * 1024)
+
+    bs4_seconds, expected = timed(bs4_text, bodies, repeat)
+    lxml_seconds, actual = timed(html_to_text, bodies, repeat)
+
+    return {
+        "bodies": len(bodies),
+        "mb": round(mbytes, 2),
+        "bs4_seconds": round(bs4_seconds, 3),
+        "html_to_text_seconds": round(lxml_seconds, 3),
+        "bs4_mb_s": round(mbytes / max(bs4_seconds, 1e-9), 2),
+        "html_to_text_mb_s": round(mbytes / max(lxml_seconds, 1e-9), 2),
+        "speedup": round(bs4_seconds / max(lxml_seconds, 1e-9), 2),
+        "mismatches": sum(1 for a, b in zip(expected, actual) if a != b),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--dir", type=str)
+    source.add_argument("--clickhouse", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    bodies = load_dir(args.dir) if args.dir else load_clickhouse(args.clickhouse)
+    print(json.dumps(run(bodies, repeat=args.repeat), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,247 @@
+"""End-to-end ingest benchmark on a synthetic corpus (see benchmarks.synth).
+
+Stages: iter_mbox (_iter_mbox over every mailbox), extract_body (MIME body
+decoding of already parsed messages), import (import_mbox_to_clickhouse)
+and upload (work/scripts/upload_sqlite_to_clickhouse.py). Each stage runs
+in a fresh process so its peak RSS is its own. Without --clickhouse the
+inserts go to an in-process stand-in that only counts rows; with it they
+go to the ClickHouse from config.py, so point that at a scratch server.
+
+Run from project/:
+    python -m benchmarks.bench_ingest --messages 20000 --workdir /tmp/mailkb-bench --out report.json
+"""
+import argparse
+import importlib.util
+import json
+import multiprocessing
+import platform
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from types import SimpleNamespace
+
+from benchmarks.synth import iter_messages, write_mbox, write_sqlite
+
+STAGES = ["iter_mbox", "extract_body", "import", "upload"]
+UPLOADER = Path(__file__).resolve().parents[2] / "work" / "scripts" / "upload_sqlite_to_clickhouse.py"
+
+
+class StandInClient:
+    """Accepts inserts like a clickhouse-connect client and drops them."""
+
+    def __init__(self, *args, **kwargs):
+        self.rows = 0
+
+    def insert(self, table, data, column_names=None, column_oriented=False, settings=None):
+        self.rows += len(data[0]) if column_oriented and data else len(data)
+
+    def query(self, *args, **kwargs):
+        return SimpleNamespace(result_rows=[["stand-in"]])
+
+    def command(self, *args, **kwargs):
+        return None
+
+
+def peak_rss_mb():
+    """Peak RSS of this process and of its finished children, in MB."""
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+
+    scale = 1 if sys.platform == "darwin" else 1024  # ru_maxrss: bytes on macOS, KB elsewhere
+    peak = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    return round(peak * scale / (1024 * 1024), 1)
+
+
+def _result(messages: int, nbytes: int, seconds: float) -> dict:
+    seconds = max(seconds, 1e-9)
+    return {
+        "messages": messages,
+        "mb": round(nbytes / (1024 * 1024), 2),
+        "seconds": round(seconds, 3),
+        "msgs_s": round(messages / seconds, 1),
+        "mb_s": round(nbytes / (1024 * 1024) / seconds, 2),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def _mbox_files(workdir: Path) -> list[Path]:
+    from pipeline import iter_mbox_files
+
+    return sorted(iter_mbox_files(workdir / "mbox"))
+
+
+def stage_iter_mbox(workdir: Path, options: dict) -> dict:
+    from pipeline import _iter_mbox
+
+    files = _mbox_files(workdir)
+    started = time.perf_counter()
+    messages = sum(1 for fp in files for _ in _iter_mbox(str(fp)))
+    return _result(messages, sum(fp.stat().st_size for fp in files), time.perf_counter() - started)
+
+
+def stage_extract_body(workdir: Path, options: dict) -> dict:
+    from pipeline import _iter_mbox, extract_body
+
+    limit = options["extract_limit"]
+    parsed = []
+    for fp in _mbox_files(workdir):
+        for msg in _iter_mbox(str(fp)):
+            parsed.append(msg)
+            if len(parsed) >= limit:
+                break
+        if len(parsed) >= limit:
+            break
+
+    started = time.perf_counter()
+    nbytes = 0
+    for msg in parsed:
+        body_text, body_html = extract_body(msg)
+        nbytes += len(body_text.encode("utf-8")) + len(body_html.encode("utf-8"))
+    return _result(len(parsed), nbytes, time.perf_counter() - started)
+
+
+def stage_import(workdir: Path, options: dict) -> dict:
+    import pipeline
+
+    pipeline.MBOX_DIR = str(workdir / "mbox")
+    pipeline.ATTACH_DIR = str(workdir / "attachments")
+    pipeline.IMPORT_STATE_DB = str(workdir / "import_state.db")
+
+    if not options["clickhouse"]:
+        pipeline.create_clickhouse_client = pipeline.get_clickhouse_client = StandInClient
+        # Import workers must inherit the patched client.
+        if options["workers"] > 1 and "fork" in multiprocessing.get_all_start_methods():
+            multiprocessing.set_start_method("fork", force=True)
+        elif options["workers"] > 1:
+            raise SystemExit("--workers > 1 with the stand-in client needs the fork start method")
+
+    started = time.perf_counter()
+    results = pipeline.import_mbox_to_clickhouse(workers=options["workers"], resume=False)
+    seconds = time.perf_counter() - started
+
+    return _result(
+        sum(r["messages"] for r in results),
+        sum(r["bytes"] for r in results),
+        seconds,
+    )
+
+
+def stage_upload(workdir: Path, options: dict) -> dict:
+    import sqlite3
+
+    spec = importlib.util.spec_from_file_location("upload_sqlite_to_clickhouse", UPLOADER)
+    uploader = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(uploader)
+
+    db_path = workdir / "mail_local.db"
+    uploader.SQLITE_DB = str(db_path)
+    uploader.WORKERS = options["workers"]
+    uploader.RESUME = False
+    uploader.MAX_ROWS = 0
+
+    if options["clickhouse"]:
+        from config import CH_HOST, CH_PORT, CLICKHOUSE_DATABASE, CLICKHOUSE_PASSWORD, CLICKHOUSE_USER
+
+        uploader.CH_HOST, uploader.CH_PORT = CH_HOST, CH_PORT
+        uploader.CH_USER, uploader.CH_PASS, uploader.CH_DB = CLICKHOUSE_USER, CLICKHOUSE_PASSWORD, CLICKHOUSE_DATABASE
+    else:
+        uploader.clickhouse_connect = SimpleNamespace(get_client=StandInClient)
+
+    conn = sqlite3.connect(str(db_path))
+    messages = conn.execute("SELECT COUNT(*) FROM emails").fetchone()[0]
+    conn.close()
+
+    started = time.perf_counter()
+    uploader.main()
+    return _result(messages, db_path.stat().st_size, time.perf_counter() - started)
+
+
+STAGE_FUNCS = {
+    "iter_mbox": stage_iter_mbox,
+    "extract_body": stage_extract_body,
+    "import": stage_import,
+    "upload": stage_upload,
+}
+
+
+def generate(workdir: Path, messages: int, seed: int, stages: list[str]) -> dict:
+    """Generate the corpora the stages need, once per workdir (see corpus.json)."""
+    manifest_path = workdir / "corpus.json"
+    corpus = {"messages": messages, "seed": seed}
+    if manifest_path.exists():
+        corpus = json.loads(manifest_path.read_text(encoding="utf-8"))
+        if (corpus["messages"], corpus["seed"]) != (messages, seed):
+            raise SystemExit(
+                f"{workdir} holds a corpus of {corpus['messages']} messages (seed {corpus['seed']}); "
+                "use another --workdir"
+            )
+
+    if set(stages) & {"iter_mbox", "extract_body", "import"} and "mbox" not in corpus:
+        print(f"[bench] generating {messages} messages into {workdir / 'mbox'}")
+        corpus["mbox"] = write_mbox(iter_messages(messages, seed), workdir / "mbox")
+    if "upload" in stages and "sqlite" not in corpus:
+        print(f"[bench] generating {messages} messages into {workdir / 'mail_local.db'}")
+        corpus["sqlite"] = write_sqlite(iter_messages(messages, seed), workdir / "mail_local.db")
+
+    manifest_path.write_text(json.dumps(corpus, indent=2), encoding="utf-8")
+    return corpus
+
+
+def run_stage(stage: str, workdir: Path, options: dict) -> dict:
+    # spawn: a clean interpreter per stage, so peak RSS is not inherited
+    ctx = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as executor:
+        return executor.submit(STAGE_FUNCS[stage], workdir, options).result()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=10000)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--workdir", type=str, default="bench_data")
+    parser.add_argument("--stages", type=str, default=",".join(STAGES))
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--extract-limit", type=int, default=5000)
+    parser.add_argument("--clickhouse", action="store_true", help="insert into the configured ClickHouse")
+    parser.add_argument("--out", type=str, default="")
+    args = parser.parse_args()
+
+    stages = [s.strip() for s in args.stages.split(",") if s.strip()]
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        parser.error(f"unknown stages: {', '.join(sorted(unknown))}")
+
+    workdir = Path(args.workdir).resolve()
+    workdir.mkdir(parents=True, exist_ok=True)
+    options = {
+        "workers": args.workers,
+        "extract_limit": args.extract_limit,
+        "clickhouse": args.clickhouse,
+    }
+
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "options": options,
+        "corpus": generate(workdir, args.messages, args.seed, stages),
+        "stages": {},
+    }
+
+    for stage in stages:
+        print(f"[bench] {stage} ...")
+        report["stages"][stage] = run_stage(stage, workdir, options)
+
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.out:
+        Path(args.out).write_text(text, encoding="utf-8")
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,357 @@
+"""Synthetic mail archives for the ingest benchmarks.
+
+Messages come in threads of geometric depth whose replies quote the whole
+history (">" quoting or Outlook / Russian Outlook separators), a share of
+them is HTML (html-only or multipart/alternative), attachments have
+log-normal sizes and are partly re-sent duplicates, and bodies use a mix
+of utf-8, cp1251, koi8-r and iso-8859-1. The same message stream can be
+written as mbox folders (MBOX_DIR layout) or as a SQLite file in the
+work/scripts/extract_pst_to_sqlite.py layout.
+
+    python -m benchmarks.synth --messages 20000 --mbox-dir /tmp/bench/mbox
+    python -m benchmarks.synth --messages 20000 --sqlite /tmp/bench/mail_local.db
+"""
+import argparse
+import hashlib
+import json
+import math
+import random
+import sqlite3
+from datetime import datetime, timedelta, timezone
+from email.message import EmailMessage
+from email.utils import format_datetime
+from pathlib import Path
+
+EN_WORDS = (
+    "project status report meeting deadline budget invoice contract review "
+    "update schedule delivery please find attached regards thanks team client "
+    "shipment approval draft version agreement payment quarter forecast risk"
+).split()
+RU_WORDS = (
+    "проект отчёт совещание срок бюджет счёт договор согласование поставка "
+    "прошу направить вложение спасибо коллеги клиент оплата квартал прогноз "
+    "риск график версия подписание уточнение замечания"
+).split()
+LATIN1_WORDS = "café résumé naïve façade déjà señor über straße fiancé entrée".split()
+
+# charset -> (share of messages, word pool that the charset can encode)
+CHARSETS = {
+    "utf-8": (0.75, EN_WORDS + RU_WORDS),
+    "cp1251": (0.12, RU_WORDS + EN_WORDS),
+    "koi8-r": (0.05, RU_WORDS),
+    "iso-8859-1": (0.08, EN_WORDS + LATIN1_WORDS),
+}
+
+FOLDERS = ["Inbox", "Sent", "Archive/2022", "Archive/2023", "Projects/Alpha", "Projects/Beta"]
+DOMAINS = ["example.com", "corp.example.com", "partner.ru", "supplier.de", "mail.ru", "gmail.com"]
+ATTACHMENT_TYPES = [
+    ("report.pdf", "application", "pdf"),
+    ("scan.jpg", "image", "jpeg"),
+    ("budget.xlsx", "application", "vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    ("contract.docx", "application", "vnd.openxmlformats-officedocument.wordprocessingml.document"),
+]
+
+DEFAULTS = {
+    "thread_continue": 0.7,       # chance a thread gets one more reply (geometric depth)
+    "max_thread_depth": 200,
+    "html_share": 0.35,
+    "html_only_share": 0.35,      # of the HTML messages, how many have no text/plain part
+    "attachment_share": 0.15,
+    "attachment_median_kb": 80,
+    "attachment_sigma": 1.4,
+    "attachment_max_mb": 8,
+    "attachment_resend_share": 0.3,
+    "max_quoted_chars": 64 * 1024,
+    "bad_date_share": 0.01,
+    "senders": 400,
+}
+
+
+def _words(rng: random.Random, pool: list[str], n: int) -> str:
+    return " ".join(rng.choice(pool) for _ in range(n))
+
+
+def _paragraphs(rng: random.Random, pool: list[str]) -> str:
+    n = max(1, int(rng.expovariate(1 / 3)))
+    return "\n\n".join(_words(rng, pool, rng.randint(8, 60)).capitalize() + "." for _ in range(n))
+
+
+def _quote(rng: random.Random, prev: dict, limit: int) -> str:
+    history = prev["text"][:limit]
+    style = rng.random()
+    if style < 0.4:
+        quoted = "\n".join("> " + line if line else ">" for line in history.splitlines())
+        return f"\n\nOn {format_datetime(prev['date'])}, {prev['from'][1]} wrote:\n{quoted}"
+    if style < 0.75:
+        return (
+            "\n\n-----Original Message-----\n"
+            f"From: {prev['from'][0]} <{prev['from'][1]}>\n"
+            f"Sent: {format_datetime(prev['date'])}\n"
+            f"To: {', '.join(a for _, a in prev['to'])}\n"
+            f"Subject: {prev['subject']}\n\n{history}"
+        )
+    return (
+        "\n\nОт: " + f"{prev['from'][0]} <{prev['from'][1]}>\n"
+        f"Отправлено: {format_datetime(prev['date'])}\n"
+        f"Кому: {', '.join(a for _, a in prev['to'])}\n"
+        f"Тема: {prev['subject']}\n\n{history}"
+    )
+
+
+def _to_html(text: str) -> str:
+    blocks = []
+    for block in text.split("\n\n"):
+        block = block.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+        if block.startswith("&gt;"):
+            blocks.append(f"<blockquote>{block.replace(chr(10), '<br>')}</blockquote>")
+        else:
+            blocks.append(f"<p>{block.replace(chr(10), '<br>')}</p>")
+    return (
+        "<html><head><style>p {margin: 0}</style></head><body>"
+        + "\n".join(blocks)
+        + "<div class=\"signature\"><table><tr><td>--<br>Sent from corporate mail</td></tr></table></div>"
+        + "</body></html>"
+    )
+
+
+def iter_messages(n: int, seed: int = 1, **options):
+    """Yield n synthetic messages as plain dicts (see write_mbox / write_sqlite)."""
+    opts = {**DEFAULTS, **options}
+    rng = random.Random(seed)
+
+    charsets = list(CHARSETS)
+    charset_weights = [CHARSETS[c][0] for c in charsets]
+
+    # Zipf-like sender popularity: a few people write most of the mail.
+    people = [
+        (f"{rng.choice(['Ivan', 'Olga', 'Peter', 'Anna', 'John', 'Maria'])} {i}",
+         f"user{i}@{rng.choice(DOMAINS)}")
+        for i in range(opts["senders"])
+    ]
+    people_weights = [1 / (i + 1) for i in range(len(people))]
+
+    blobs = []
+    now = datetime(2019, 1, 1, tzinfo=timezone.utc)
+    produced = 0
+    thread_no = 0
+
+    while produced < n:
+        thread_no += 1
+        charset = rng.choices(charsets, charset_weights)[0]
+        pool = CHARSETS[charset][1]
+        base_subject = _words(rng, pool, rng.randint(2, 6)).capitalize()
+        folder = rng.choices(FOLDERS, [8, 4, 2, 2, 1, 1])[0]
+        participants = rng.choices(people, people_weights, k=rng.randint(2, 6))
+
+        prev = None
+        depth = 0
+        while produced < n and depth < opts["max_thread_depth"]:
+            sender = rng.choice(participants)
+            recipients = [p for p in participants if p != sender] or [rng.choice(people)]
+            now += timedelta(minutes=rng.expovariate(1 / 90))
+
+            text = _paragraphs(rng, pool)
+            subject = base_subject if prev is None else "Re: " + base_subject
+            if prev is not None:
+                text += _quote(rng, prev, opts["max_quoted_chars"])
+
+            attachments = []
+            if rng.random() < opts["attachment_share"]:
+                if blobs and rng.random() < opts["attachment_resend_share"]:
+                    attachments.append(rng.choice(blobs))
+                else:
+                    size = int(rng.lognormvariate(math.log(opts["attachment_median_kb"] * 1024), opts["attachment_sigma"]))
+                    size = max(64, min(size, opts["attachment_max_mb"] * 1024 * 1024))
+                    name, maintype, subtype = rng.choice(ATTACHMENT_TYPES)
+                    blob = (name, maintype, subtype, rng.randbytes(size))
+                    blobs.append(blob)
+                    if len(blobs) > 200:
+                        blobs.pop(0)
+                    attachments.append(blob)
+
+            # e.g. a Russian Outlook separator quoted into an iso-8859-1 reply
+            msg_charset = charset
+            try:
+                text.encode(charset)
+            except UnicodeEncodeError:
+                msg_charset = "utf-8"
+
+            is_html = rng.random() < opts["html_share"]
+            date_raw = format_datetime(now.astimezone(timezone(timedelta(hours=rng.choice([0, 1, 3, -5])))))
+            if rng.random() < opts["bad_date_share"]:
+                date_raw = "sometime last week"
+
+            msg = {
+                "folder": folder,
+                "message_id": f"<{thread_no}.{depth}.{seed}@synth.example.com>",
+                "in_reply_to": prev["message_id"] if prev else "",
+                "subject": subject,
+                "from": sender,
+                "to": recipients[:3],
+                "cc": recipients[3:],
+                "date": now,
+                "date_raw": date_raw,
+                "charset": msg_charset,
+                "text": text,
+                "html": _to_html(text) if is_html else "",
+                "html_only": is_html and rng.random() < opts["html_only_share"],
+                "attachments": attachments,
+            }
+            yield msg
+
+            produced += 1
+            depth += 1
+            prev = msg
+            if rng.random() > opts["thread_continue"]:
+                break
+
+
+def to_email_message(m: dict) -> EmailMessage:
+    msg = EmailMessage()
+    msg["Subject"] = m["subject"]
+    msg["From"] = f"{m['from'][0]} <{m['from'][1]}>"
+    msg["To"] = ", ".join(f"{name} <{addr}>" for name, addr in m["to"])
+    if m["cc"]:
+        msg["Cc"] = ", ".join(f"{name} <{addr}>" for name, addr in m["cc"])
+    msg["Date"] = m["date_raw"]
+    msg["Message-ID"] = m["message_id"]
+    if m["in_reply_to"]:
+        msg["In-Reply-To"] = m["in_reply_to"]
+        msg["References"] = m["in_reply_to"]
+
+    if m["html"] and m["html_only"]:
+        msg.set_content(m["html"], subtype="html", charset=m["charset"])
+    else:
+        msg.set_content(m["text"], charset=m["charset"])
+        if m["html"]:
+            msg.add_alternative(m["html"], subtype="html", charset=m["charset"])
+
+    for name, maintype, subtype, data in m["attachments"]:
+        msg.add_attachment(data, maintype=maintype, subtype=subtype, filename=name)
+
+    return msg
+
+
+def write_mbox(messages, base_dir) -> dict:
+    """Write messages into <base_dir>/<folder>/mbox files; return corpus counters."""
+    base = Path(base_dir)
+    handles = {}
+    stats = {"messages": 0, "bytes": 0, "attachments": 0, "html": 0}
+
+    try:
+        for m in messages:
+            fh = handles.get(m["folder"])
+            if fh is None:
+                folder_dir = base / m["folder"]
+                folder_dir.mkdir(parents=True, exist_ok=True)
+                fh = handles[m["folder"]] = open(folder_dir / "mbox", "wb")
+
+            data = to_email_message(m).as_bytes().replace(b"\nFrom ", b"\n>From ")
+            envelope = f"From {m['from'][1]} {m['date'].strftime('%a %b %d %H:%M:%S %Y')}\n".encode()
+            fh.write(envelope + data + b"\n\n")
+
+            stats["messages"] += 1
+            stats["bytes"] += len(envelope) + len(data) + 2
+            stats["attachments"] += len(m["attachments"])
+            stats["html"] += bool(m["html"])
+    finally:
+        for fh in handles.values():
+            fh.close()
+
+    return stats
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS emails(
+  id TEXT PRIMARY KEY,
+  message_id TEXT,
+  subject TEXT,
+  from_addr_json TEXT,
+  to_addr_json TEXT,
+  cc_addr_json TEXT,
+  bcc_addr_json TEXT,
+  sent_at_utc TEXT,
+  sent_at_raw TEXT,
+  folder TEXT,
+  source_pst TEXT,
+  body_len INTEGER,
+  body_text TEXT,
+  body_html TEXT
+);
+
+CREATE TABLE IF NOT EXISTS attachments(
+  email_id TEXT,
+  filename TEXT,
+  path TEXT,
+  size_bytes INTEGER
+);
+"""
+
+
+def write_sqlite(messages, db_path, batch: int = 1000) -> dict:
+    """Write messages as a staged SQLite file (extract_pst_to_sqlite.py layout)."""
+    conn = sqlite3.connect(str(db_path))
+    conn.executescript(SQLITE_SCHEMA)
+    stats = {"messages": 0, "bytes": 0, "attachments": 0, "html": 0}
+
+    emails, atts = [], []
+
+    def flush():
+        conn.executemany("INSERT OR IGNORE INTO emails VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?)", emails)
+        conn.executemany("INSERT INTO attachments VALUES (?,?,?,?)", atts)
+        conn.commit()
+        emails.clear()
+        atts.clear()
+
+    for m in messages:
+        email_id = hashlib.md5(m["message_id"].encode()).hexdigest()
+        emails.append((
+            email_id,
+            m["message_id"],
+            m["subject"],
+            json.dumps([m["from"][1]], ensure_ascii=False),
+            json.dumps([a for _, a in m["to"]], ensure_ascii=False),
+            json.dumps([a for _, a in m["cc"]], ensure_ascii=False),
+            "[]",
+            m["date"].isoformat(),
+            m["date_raw"],
+            m["folder"],
+            "synthetic.pst",
+            len(m["text"]),
+            m["text"],
+            m["html"],
+        ))
+        for name, _, _, data in m["attachments"]:
+            atts.append((email_id, name, "", len(data)))
+
+        stats["messages"] += 1
+        stats["bytes"] += len(m["text"].encode()) + len(m["html"].encode())
+        stats["attachments"] += len(m["attachments"])
+        stats["html"] += bool(m["html"])
+
+        if len(emails) >= batch:
+            flush()
+
+    flush()
+    conn.close()
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=10000)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--mbox-dir", type=str, default="")
+    parser.add_argument("--sqlite", type=str, default="")
+    args = parser.parse_args()
+
+    report = {}
+    if args.mbox_dir:
+        report["mbox"] = write_mbox(iter_messages(args.messages, args.seed), args.mbox_dir)
+    if args.sqlite:
+        report["sqlite"] = write_sqlite(iter_messages(args.messages, args.seed), args.sqlite)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
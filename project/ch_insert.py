@@ -0,0 +1,99 @@
+"""Column-oriented bulk inserts into ClickHouse.
+
+Kept free of project config/LLM imports so the standalone scripts in
+work/scripts can use it with their own ClickHouse client.
+"""
+import threading
+import time
+
+
+def rows_to_columns(rows, n_columns: int) -> list[list]:
+    if not rows:
+        return [[] for _ in range(n_columns)]
+    return [list(col) for col in zip(*rows)]
+
+
+def _column_bytes(column) -> int:
+    if not column:
+        return 0
+
+    first = column[0]
+    if isinstance(first, (str, bytes)):
+        return sum(map(len, column))
+    if isinstance(first, (list, tuple)):
+        return sum(len(v) for values in column for v in values)
+    return 8 * len(column)
+
+
+class InsertStats:
+    """Thread-safe rows/bytes/time counters for one ingest stage."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.rows = 0
+        self.bytes = 0
+        self.seconds = 0.0
+
+    def add(self, rows: int, nbytes: int, seconds: float):
+        with self.lock:
+            self.rows += rows
+            self.bytes += nbytes
+            self.seconds += seconds
+
+    def merge(self, other: dict):
+        self.add(other.get("rows", 0), other.get("bytes", 0), other.get("seconds", 0.0))
+
+    def as_dict(self) -> dict:
+        return {"rows": self.rows, "bytes": self.bytes, "seconds": self.seconds}
+
+    def summary(self) -> str:
+        seconds = max(self.seconds, 1e-6)
+        return (
+            f"inserted_rows={self.rows}, inserted_MB={self.bytes / (1024 * 1024):.1f}, "
+            f"insert_rows/s={self.rows / seconds:.0f}, "
+            f"insert_MB/s={self.bytes / (1024 * 1024) / seconds:.2f}"
+        )
+
+
+def bulk_insert(
+    client,
+    table: str,
+    data,
+    column_names: list[str],
+    columnar: bool = False,
+    async_insert: bool = False,
+    stats: InsertStats | None = None,
+) -> int:
+    """Insert rows (or ready-made columns when columnar=True) column-oriented.
+
+    clickhouse-connect serializes column lists without transposing every
+    row on the client, which is where the row path spends its time.
+    async_insert lets the server buffer small inserts from many writers.
+    Returns the number of inserted rows.
+    """
+    columns = data if columnar else rows_to_columns(data, len(column_names))
+    n_rows = len(columns[0]) if columns else 0
+    if n_rows == 0:
+        return 0
+
+    settings = None
+    if async_insert:
+        settings = {"async_insert": 1, "wait_for_async_insert": 1}
+
+    started = time.perf_counter()
+    client.insert(
+        table,
+        columns,
+        column_names=column_names,
+        column_oriented=True,
+        settings=settings,
+    )
+
+    if stats is not None:
+        stats.add(
+            n_rows,
+            sum(_column_bytes(col) for col in columns),
+            time.perf_counter() - started,
+        )
+
+    return n_rows
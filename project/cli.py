@@ -1,10 +1,23 @@
 import argparse
+from datetime import datetime
 
+from config import (
+    CLEAN_MAX_IN_FLIGHT,
+    DEDUP_PROCESSES,
+    DEDUP_WORKERS,
+    IMPORT_WORKERS,
+    NEAR_DUP_NUM_PERM,
+    NEAR_DUP_THRESHOLD,
+    PST_SPILL_DB,
+)
 from pipeline import (
+    ImportFilter,
     clean_email_bodies_from_db,
     deduplicate_emails,
     import_mbox_to_clickhouse,
+    import_pst_to_clickhouse,
     index_messages,
+    near_dedup_emails,
     parse_emails_from_db,
 )
 from retrieval import clear_summaries, run_batch_analysis, run_global_analysis
@@ -16,12 +29,34 @@ def main():
 
     import_parser = subparsers.add_parser("import-mbox")
     import_parser.add_argument("--max-emails", type=int, default=0)
-    subparsers.add_parser("dedup")
+    import_parser.add_argument("--workers", type=int, default=IMPORT_WORKERS)
+    import_parser.add_argument("--no-resume", action="store_true")
+    import_parser.add_argument("--date-from", type=datetime.fromisoformat, default=None)
+    import_parser.add_argument("--date-to", type=datetime.fromisoformat, default=None)
+    import_parser.add_argument("--folder", action="append", default=[])
+    import_parser.add_argument("--sender-domain", action="append", default=[])
+
+    import_pst_parser = subparsers.add_parser("import-pst")
+    import_pst_parser.add_argument("--max-emails", type=int, default=0)
+    import_pst_parser.add_argument("--workers", type=int, default=IMPORT_WORKERS)
+    import_pst_parser.add_argument("--no-resume", action="store_true")
+    import_pst_parser.add_argument("--spill-db", type=str, default=PST_SPILL_DB)
+
+    dedup_parser = subparsers.add_parser("dedup")
+    dedup_parser.add_argument("--workers", type=int, default=DEDUP_WORKERS)
+    dedup_parser.add_argument("--full", action="store_true")
+    dedup_parser.add_argument("--processes", type=int, default=DEDUP_PROCESSES)
+
+    near_dedup_parser = subparsers.add_parser("near-dedup")
+    near_dedup_parser.add_argument("--threshold", type=float, default=NEAR_DUP_THRESHOLD)
+    near_dedup_parser.add_argument("--num-perm", type=int, default=NEAR_DUP_NUM_PERM)
     subparsers.add_parser("clear-summaries")
 
     clean_parser = subparsers.add_parser("clean-bodies")
     clean_parser.add_argument("--fetch-batch", type=int, default=30)
     clean_parser.add_argument("--llm-batch", type=int, default=5)
+    clean_parser.add_argument("--no-preclean", action="store_true")
+    clean_parser.add_argument("--max-in-flight", type=int, default=CLEAN_MAX_IN_FLIGHT)
 
     parse_parser = subparsers.add_parser("parse")
     parse_parser.add_argument("--limit", type=int, default=50)
@@ -42,13 +77,34 @@ def main():
     args = parser.parse_args()
 
     if args.command == "import-mbox":
-        import_mbox_to_clickhouse(max_emails=args.max_emails)
+        import_mbox_to_clickhouse(
+            max_emails=args.max_emails,
+            workers=args.workers,
+            resume=not args.no_resume,
+            header_filter=ImportFilter(
+                date_from=args.date_from,
+                date_to=args.date_to,
+                folders=args.folder,
+                sender_domains=args.sender_domain,
+            ),
+        )
+    elif args.command == "import-pst":
+        import_pst_to_clickhouse(
+            max_emails=args.max_emails,
+            workers=args.workers,
+            resume=not args.no_resume,
+            spill_db=args.spill_db,
+        )
     elif args.command == "dedup":
-        deduplicate_emails()
+        deduplicate_emails(workers=args.workers, full=args.full, processes=args.processes)
+    elif args.command == "near-dedup":
+        print(near_dedup_emails(threshold=args.threshold, num_perm=args.num_perm))
     elif args.command == "clean-bodies":
         clean_email_bodies_from_db(
             fetch_batch=args.fetch_batch,
             llm_batch=args.llm_batch,
+            preclean=not args.no_preclean,
+            max_in_flight=args.max_in_flight,
         )
     elif args.command == "parse":
         result = parse_emails_from_db(
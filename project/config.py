@@ -11,16 +11,63 @@ CH_PORT = int(os.getenv("CH_PORT", "8123"))
 CLICKHOUSE_USER = os.getenv("CLICKHOUSE_USER", "peter")
 CLICKHOUSE_PASSWORD = os.getenv("CLICKHOUSE_PASSWORD", "1234")
 CLICKHOUSE_DATABASE = os.getenv("CLICKHOUSE_DATABASE", "mailkb")
+# server-side buffering of inserts (async_insert=1, wait_for_async_insert=1)
+CH_ASYNC_INSERT = os.getenv("CH_ASYNC_INSERT", "false").lower() == "true"
 
 # Raw import
 MBOX_DIR = os.getenv("MBOX_DIR", r"E:\outlook\mbox")
 ATTACH_DIR = os.getenv("ATTACH_DIR", r"E:\outlook\attachments")
+PST_DIR = os.getenv("PST_DIR", r"E:\outlook")
+# optional SQLite copy of PST rows in the extract_pst_to_sqlite.py layout ("" = off)
+PST_SPILL_DB = os.getenv("PST_SPILL_DB", "")
 SAVE_ATTACHMENTS = os.getenv("SAVE_ATTACHMENTS", "true").lower() == "true"
-BATCH = int(os.getenv("BATCH", "500"))
+# background threads writing content-addressed attachment blobs
+ATTACH_IO_WORKERS = int(os.getenv("ATTACH_IO_WORKERS", "4"))
+BATCH = int(os.getenv("BATCH", "5000"))
 CHUNK_SIZE = int(os.getenv("CHUNK_SIZE", "20000"))
+# threads deduplicating thread_key chunks in parallel (each with its own ClickHouse client)
+DEDUP_WORKERS = int(os.getenv("DEDUP_WORKERS", "1"))
+# processes running the containment check of each chunk (1 = in the calling thread)
+DEDUP_PROCESSES = int(os.getenv("DEDUP_PROCESSES", "1"))
+# near-dedup: estimated Jaccard similarity of word shingles that makes two bodies one cluster
+NEAR_DUP_THRESHOLD = float(os.getenv("NEAR_DUP_THRESHOLD", "0.85"))
+NEAR_DUP_NUM_PERM = int(os.getenv("NEAR_DUP_NUM_PERM", "64"))
+NEAR_DUP_SHINGLE = int(os.getenv("NEAR_DUP_SHINGLE", "5"))
+# shorter bodies ("Thanks!", "OK") are never clustered
+NEAR_DUP_MIN_WORDS = int(os.getenv("NEAR_DUP_MIN_WORDS", "20"))
+# "content": id derived from Message-ID + normalized headers/body (stable across re-imports)
+# "random": uuid4 per imported message
+EMAIL_ID_MODE = os.getenv("EMAIL_ID_MODE", "content").lower()
+IMPORT_WORKERS = int(os.getenv("IMPORT_WORKERS", "1"))
+# mbox files bigger than this are split into byte ranges for parallel import (0 = never)
+MBOX_SPLIT_BYTES = int(os.getenv("MBOX_SPLIT_BYTES", str(256 * 1024 * 1024)))
+# import insert pipeline: batches are flushed at IMPORT_BATCH_BYTES of row data (or BATCH rows)
+# and handed to IMPORT_INSERT_WORKERS threads through a queue of IMPORT_QUEUE_SIZE batches
+IMPORT_BATCH_BYTES = int(os.getenv("IMPORT_BATCH_BYTES", str(32 * 1024 * 1024)))
+IMPORT_INSERT_WORKERS = int(os.getenv("IMPORT_INSERT_WORKERS", "1"))
+IMPORT_QUEUE_SIZE = int(os.getenv("IMPORT_QUEUE_SIZE", "4"))
+# local SQLite file with per-mailbox import checkpoints
+IMPORT_STATE_DB = os.getenv("IMPORT_STATE_DB", "import_state.db")
+# entries per memoized header decoder (decode_mime / parse_addrs / parse_date)
+HEADER_CACHE_SIZE = int(os.getenv("HEADER_CACHE_SIZE", "65536"))
 
 # Models
 LLM_MODEL = os.getenv("LLM_MODEL", "deepseek-chat")
+# clean-bodies: cut quoted history by rules before the LLM; residuals up to
+# PRECLEAN_MAX_CHARS with no headers/signature left are stored without an LLM call
+PRECLEAN = os.getenv("PRECLEAN", "true").lower() == "true"
+PRECLEAN_MAX_CHARS = int(os.getenv("PRECLEAN_MAX_CHARS", "1500"))
+# clean-bodies: concurrent LLM requests, provider limits (0 = unlimited) and
+# cache rows buffered per ClickHouse insert
+CLEAN_MAX_IN_FLIGHT = int(os.getenv("CLEAN_MAX_IN_FLIGHT", "4"))
+LLM_REQUESTS_PER_MIN = int(os.getenv("LLM_REQUESTS_PER_MIN", "0"))
+LLM_TOKENS_PER_MIN = int(os.getenv("LLM_TOKENS_PER_MIN", "0"))
+CLEAN_INSERT_BATCH = int(os.getenv("CLEAN_INSERT_BATCH", "500"))
+# clean/parse requests are packed up to these estimated token budgets (besides the
+# llm_batch / batch_size item caps); tiktoken encoding used for the estimates
+LLM_PROMPT_TOKEN_BUDGET = int(os.getenv("LLM_PROMPT_TOKEN_BUDGET", "24000"))
+LLM_OUTPUT_TOKEN_BUDGET = int(os.getenv("LLM_OUTPUT_TOKEN_BUDGET", "4000"))
+LLM_TOKEN_ENCODING = os.getenv("LLM_TOKEN_ENCODING", "cl100k_base")
 EMBEDDINGS_BASE_URL = os.getenv("EMBEDDINGS_BASE_URL", "http://localhost:8000/v1")
 EMBEDDINGS_MODEL = os.getenv("EMBEDDINGS_MODEL", "Qwen/Qwen3-Embedding-0.6B")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
@@ -21,8 +21,7 @@ from config import (
 )
 
 
-@lru_cache(maxsize=1)
-def get_clickhouse_client():
+def create_clickhouse_client():
     return clickhouse_connect.get_client(
         host=CH_HOST,
         port=CH_PORT,
@@ -32,6 +31,11 @@ def get_clickhouse_client():
     )
 
 
+@lru_cache(maxsize=1)
+def get_clickhouse_client():
+    return create_clickhouse_client()
+
+
 @lru_cache(maxsize=1)
 def get_qdrant_client():
     return QdrantClient(url=QDRANT_URL)
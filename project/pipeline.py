@@ -1,50 +1,91 @@
+import fnmatch
 import hashlib
 import json
 import mailbox
+import mmap
+import multiprocessing
 import os
+import queue
 import re
+import sqlite3
+import struct
+import threading
 import time
 import uuid
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import zlib
+from array import array
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
+from contextlib import nullcontext
 from datetime import datetime, timezone
+from functools import lru_cache
 from email.header import decode_header
+from email.parser import BytesHeaderParser
 from email import policy
 from email.utils import getaddresses, parsedate_to_datetime
 from pathlib import Path
 from typing import List
 
+import numpy as np
 import pandas as pd
 from bs4 import BeautifulSoup
 from langchain_core.documents import Document
 from langchain_core.messages import HumanMessage, SystemMessage
+from lxml import etree
 from pydantic import BaseModel, Field, field_validator, model_validator
 from tqdm import tqdm
 
+from ch_insert import InsertStats, bulk_insert
 from config import (
     ATTACH_DIR,
+    ATTACH_IO_WORKERS,
     BATCH,
+    CH_ASYNC_INSERT,
     CHUNK_SIZE,
+    CLEAN_INSERT_BATCH,
+    CLEAN_MAX_IN_FLIGHT,
+    DEDUP_PROCESSES,
+    DEDUP_WORKERS,
+    EMAIL_ID_MODE,
+    HEADER_CACHE_SIZE,
+    IMPORT_BATCH_BYTES,
+    IMPORT_INSERT_WORKERS,
+    IMPORT_QUEUE_SIZE,
+    IMPORT_STATE_DB,
+    IMPORT_WORKERS,
     LLM_MODEL,
+    LLM_OUTPUT_TOKEN_BUDGET,
+    LLM_PROMPT_TOKEN_BUDGET,
+    LLM_REQUESTS_PER_MIN,
+    LLM_TOKEN_ENCODING,
+    LLM_TOKENS_PER_MIN,
     MBOX_DIR,
+    MBOX_SPLIT_BYTES,
     MESSAGES_COLLECTION,
+    NEAR_DUP_MIN_WORDS,
+    NEAR_DUP_NUM_PERM,
+    NEAR_DUP_SHINGLE,
+    NEAR_DUP_THRESHOLD,
+    PRECLEAN,
+    PRECLEAN_MAX_CHARS,
+    PST_DIR,
+    PST_SPILL_DB,
     SAVE_ATTACHMENTS,
 )
 from infra import (
     _get_llm,
     build_structured_agent,
+    create_clickhouse_client,
     ensure_collection,
     get_clickhouse_client,
 )
+from rate_limit import RateLimiter
 
 
 # =========================================================
 # 1. import mbox -> ClickHouse
 # =========================================================
 
-def decode_mime(value):
-    if not value:
-        return ""
-
+def _decode_mime(value):
     parts = decode_header(value)
     result = ""
 
@@ -60,17 +101,12 @@ def decode_mime(value):
     return result
 
 
-def parse_addrs(value):
-    if not value:
-        return []
+def _parse_addrs(value):
     decoded = decode_mime(value)
-    return [addr for _, addr in getaddresses([decoded]) if addr]
+    return tuple(addr for _, addr in getaddresses([decoded]) if addr)
 
 
-def parse_date(value):
-    if not value:
-        return datetime(1970, 1, 1, tzinfo=timezone.utc)
-
+def _parse_date(value):
     try:
         dt = parsedate_to_datetime(value)
         if dt.tzinfo is None:
@@ -80,6 +116,71 @@ def parse_date(value):
         return datetime(1970, 1, 1, tzinfo=timezone.utc)
 
 
+# Big archives repeat the same From/To/Cc strings and Date formats over and
+# over, so the decoders are memoized. Only plain strings are cached: compat32
+# hands out email.header.Header objects for raw 8-bit headers, and those are
+# not hashable.
+_decode_mime_cached = lru_cache(maxsize=HEADER_CACHE_SIZE)(_decode_mime)
+_parse_addrs_cached = lru_cache(maxsize=HEADER_CACHE_SIZE)(_parse_addrs)
+_parse_date_cached = lru_cache(maxsize=HEADER_CACHE_SIZE)(_parse_date)
+
+HEADER_CACHES = {
+    "decode_mime": _decode_mime_cached,
+    "parse_addrs": _parse_addrs_cached,
+    "parse_date": _parse_date_cached,
+}
+
+
+def decode_mime(value):
+    if not value:
+        return ""
+    if isinstance(value, str):
+        return _decode_mime_cached(str(value))
+    return _decode_mime(value)
+
+
+def parse_addrs(value):
+    if not value:
+        return []
+    if isinstance(value, str):
+        return list(_parse_addrs_cached(str(value)))
+    return list(_parse_addrs(value))
+
+
+def parse_date(value):
+    if not value:
+        return datetime(1970, 1, 1, tzinfo=timezone.utc)
+    if isinstance(value, str):
+        return _parse_date_cached(str(value))
+    return _parse_date(value)
+
+
+def header_cache_counters() -> dict:
+    """Current (hits, misses) of each header decoder cache in this process."""
+    counters = {}
+    for name, cached in HEADER_CACHES.items():
+        info = cached.cache_info()
+        counters[name] = (info.hits, info.misses)
+    return counters
+
+
+def header_cache_delta(before: dict) -> dict:
+    after = header_cache_counters()
+    return {
+        name: (after[name][0] - before[name][0], after[name][1] - before[name][1])
+        for name in after
+    }
+
+
+def format_header_cache(counters: dict) -> str:
+    parts = []
+    for name, (hits, misses) in counters.items():
+        total = hits + misses
+        rate = 100.0 * hits / total if total else 0.0
+        parts.append(f"{name}={rate:.1f}% ({hits}/{total})")
+    return "header cache hit rate: " + ", ".join(parts)
+
+
 def ensure_dir(p):
     Path(p).mkdir(parents=True, exist_ok=True)
 
@@ -90,24 +191,112 @@ def iter_mbox_files(base):
             yield mbox_path
 
 
-def _iter_mbox(fp: str):
-    """Read mbox file, yield email.message.Message objects.
-    
-    Replacement for mailbox.mbox which hangs on large files with Python 3.14.
+MBOX_INDEX_MAGIC = b"MBOXIDX1"
+MBOX_INDEX_HEADER = struct.Struct("<8sQQQ")
+
+
+def mbox_index_path(fp) -> Path:
+    fp = Path(fp)
+    return fp.with_name(fp.name + ".idx")
+
+
+def scan_mbox_offsets(fp) -> array:
+    """Find the byte offset of every message in an mbox file.
+
+    A message starts at byte 0 and after every line break followed by
+    "From ", the same rule _iter_mbox uses line by line.
     """
-    import email
-    from email import policy as _policy
+    offsets = array("Q")
+
+    with open(fp, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return offsets
+
+        offsets.append(0)
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            pos = mm.find(b"\nFrom ")
+            while pos != -1:
+                offsets.append(pos + 1)
+                pos = mm.find(b"\nFrom ", pos + 1)
+
+    return offsets
+
+
+def load_mbox_index(fp) -> array:
+    """Return message offsets for fp, using the <mbox>.idx file next to it.
+
+    The index is rebuilt when the mbox size or mtime no longer match.
+    A read-only archive just means the index is not persisted.
+    """
+    st = os.stat(fp)
+    idx_path = mbox_index_path(fp)
+
+    try:
+        raw = idx_path.read_bytes()
+        magic, size, mtime_ns, count = MBOX_INDEX_HEADER.unpack_from(raw)
+        if magic == MBOX_INDEX_MAGIC and size == st.st_size and mtime_ns == st.st_mtime_ns:
+            offsets = array("Q")
+            offsets.frombytes(raw[MBOX_INDEX_HEADER.size:])
+            if len(offsets) == count:
+                return offsets
+    except (OSError, struct.error):
+        pass
+
+    offsets = scan_mbox_offsets(fp)
+
+    try:
+        header = MBOX_INDEX_HEADER.pack(MBOX_INDEX_MAGIC, st.st_size, st.st_mtime_ns, len(offsets))
+        idx_path.write_bytes(header + offsets.tobytes())
+    except OSError:
+        pass
+
+    return offsets
+
+
+def split_mbox_ranges(fp, part_bytes: int, start: int = 0) -> list[tuple[int, int]]:
+    """Cut an mbox file (from byte start on) into ranges of roughly part_bytes each.
+
+    Every range starts on a message boundary, so each one can be parsed
+    independently with _iter_mbox(fp, start, end).
+    """
+    size = os.path.getsize(fp)
+    if part_bytes <= 0 or size - start <= part_bytes:
+        return [(start, size)]
+
+    offsets = load_mbox_index(fp)
+    ranges = []
+
+    for offset in offsets:
+        if offset - start >= part_bytes:
+            ranges.append((start, offset))
+            start = offset
+
+    ranges.append((start, size))
+    return ranges
+
+
+def _iter_mbox_raw(fp: str, start: int = 0, end: int | None = None):
+    """Yield (next_offset, message_bytes) for every message in a byte range.
 
+    next_offset is where the following message starts, i.e. the point an
+    import can resume from once this message has been committed.
+    """
     buf = []
     with open(fp, "rb") as f:
+        f.seek(start)
+        pos = start
+
         for raw_line in f:
+            if end is not None and pos >= end:
+                break
+            line_start = pos
+            pos += len(raw_line)
+
             if raw_line.startswith(b"From "):
                 if buf:
                     msg_bytes = b"".join(buf)
                     if msg_bytes.strip():
-                        yield email.message_from_bytes(
-                            msg_bytes, policy=_policy.compat32
-                        )
+                        yield line_start, msg_bytes
                 buf = []
             elif raw_line.startswith(b">From "):
                 buf.append(raw_line[1:])
@@ -117,7 +306,102 @@ def _iter_mbox(fp: str):
         if buf:
             msg_bytes = b"".join(buf)
             if msg_bytes.strip():
-                yield email.message_from_bytes(msg_bytes, policy=_policy.compat32)
+                yield pos, msg_bytes
+
+
+def _iter_mbox(fp: str, start: int = 0, end: int | None = None):
+    """Read mbox file, yield email.message.Message objects.
+    
+    Replacement for mailbox.mbox which hangs on large files with Python 3.14.
+    start/end restrict reading to a byte range that begins on a message
+    boundary (see split_mbox_ranges).
+    """
+    import email
+    from email import policy as _policy
+
+    for _, msg_bytes in _iter_mbox_raw(fp, start, end):
+        yield email.message_from_bytes(msg_bytes, policy=_policy.compat32)
+
+
+# Same string filtering as BeautifulSoup(html, "lxml").get_text("\n"):
+# strings inside these tags are not NavigableStrings there and are dropped.
+HTML_SKIP_TEXT_TAGS = {"script", "style", "template", "rt", "rp"}
+HTML_PRESERVE_WHITESPACE_TAGS = {"pre", "textarea"}
+HTML_FEED_CHUNK = 64 * 1024
+_ASCII_SPACES = str.maketrans("", "", " \n\t\x0c\r")
+
+
+class _HtmlTextCollector:
+    """lxml parser target that keeps only text nodes, never building a tree."""
+
+    def __init__(self):
+        self.parts = []
+        self.pending = []
+        self.open_tags = []
+        self.skip_depth = 0
+
+    def _flush(self):
+        if not self.pending:
+            return
+        text = "".join(self.pending)
+        self.pending = []
+
+        if self.skip_depth:
+            return
+
+        if not text.translate(_ASCII_SPACES) and not any(
+            tag in HTML_PRESERVE_WHITESPACE_TAGS for tag in self.open_tags
+        ):
+            text = "\n" if "\n" in text else " "
+
+        self.parts.append(text)
+
+    def start(self, tag, attrib):
+        self._flush()
+        self.open_tags.append(tag)
+        if tag in HTML_SKIP_TEXT_TAGS:
+            self.skip_depth += 1
+
+    def end(self, tag):
+        self._flush()
+        if self.open_tags:
+            closed = self.open_tags.pop()
+            if closed in HTML_SKIP_TEXT_TAGS:
+                self.skip_depth -= 1
+
+    def data(self, data):
+        self.pending.append(data)
+
+    def comment(self, text):
+        self._flush()
+
+    def pi(self, target, data=None):
+        self._flush()
+
+    def doctype(self, *args):
+        self._flush()
+
+    def close(self):
+        self._flush()
+        return "\n".join(self.parts)
+
+
+def html_to_text(html: str) -> str:
+    """Text of an HTML body, same output as BeautifulSoup(html, "lxml").get_text("\n").
+
+    Streams the markup through lxml's parser-target interface in chunks,
+    so no element tree or soup objects are built for large newsletters.
+    """
+    if not html:
+        return ""
+
+    try:
+        parser = etree.HTMLParser(target=_HtmlTextCollector(), recover=True)
+        for i in range(0, len(html), HTML_FEED_CHUNK):
+            parser.feed(html[i:i + HTML_FEED_CHUNK])
+        return parser.close()
+    except Exception:
+        return BeautifulSoup(html, "lxml").get_text("\n")
 
 
 def extract_body(msg):
@@ -162,182 +446,1203 @@ def extract_body(msg):
     return body_text, body_html
 
 
-def import_mbox_to_clickhouse(max_emails: int = 0):
-    client = get_clickhouse_client()
+EMAIL_COLUMNS = [
+    "id",
+    "message_id",
+    "thread_id",
+    "subject",
+    "from_addr",
+    "to_addr",
+    "cc_addr",
+    "bcc_addr",
+    "sent_at_utc",
+    "sent_at_raw",
+    "folder",
+    "body_text",
+    "body_html",
+]
+
+ATTACH_COLUMNS = [
+    "email_id",
+    "filename",
+    "path",
+    "size_bytes",
+    "sha256",
+]
+
+
+def mbox_folder_name(mbox_path) -> str:
+    folder_name = str(Path(mbox_path).parent.relative_to(MBOX_DIR))
+    return folder_name.replace("\\", "/")
+
+
+class ImportFilter(BaseModel):
+    """Header-level filter for importing a slice of an archive.
+
+    Folders are matched against the mailbox folder (e.g. "Inbox/*") before
+    a mailbox is opened; dates and sender domains against the parsed
+    headers, before the body and attachments are decoded.
+    """
 
-    emails_rows = []
-    attach_rows = []
-    total = 0
+    date_from: datetime | None = None
+    date_to: datetime | None = None
+    folders: list[str] = Field(default_factory=list)
+    sender_domains: list[str] = Field(default_factory=list)
 
-    ensure_dir(ATTACH_DIR)
+    def is_active(self) -> bool:
+        return bool(self.date_from or self.date_to or self.folders or self.sender_domains)
 
-    for mbox_path in iter_mbox_files(MBOX_DIR):
-        if max_emails > 0 and total >= max_emails:
-            break
-        print("Processing:", mbox_path)
+    def matches_folder(self, folder_name: str) -> bool:
+        if not self.folders:
+            return True
+        return any(fnmatch.fnmatch(folder_name, pattern) for pattern in self.folders)
 
-        folder_name = str(mbox_path.parent.relative_to(MBOX_DIR))
-        folder_name = folder_name.replace("\\", "/")
+    def matches_headers(self, headers) -> bool:
+        if self.date_from or self.date_to:
+            sent_utc = parse_date(headers.get("Date"))
+            if self.date_from and sent_utc < _as_utc(self.date_from):
+                return False
+            if self.date_to and sent_utc >= _as_utc(self.date_to):
+                return False
 
-        for msg in tqdm(_iter_mbox(str(mbox_path)), desc=folder_name):
-            if max_emails > 0 and total >= max_emails:
-                break
-            total += 1
-            stable_id = str(uuid.uuid4())
-
-            message_id = str((msg.get("Message-ID") or msg.get("Message-Id") or "").strip())
-            subject = str(decode_mime(msg.get("Subject", "")) or "")
-
-            from_addr = parse_addrs(msg.get("From"))
-            to_addr = parse_addrs(msg.get("To"))
-            cc_addr = parse_addrs(msg.get("Cc"))
-            bcc_addr = parse_addrs(msg.get("Bcc"))
-
-            raw_date_value = msg.get("Date")
-            sent_raw = "" if raw_date_value is None else str(raw_date_value)
-            sent_utc = parse_date(raw_date_value)
-
-            thread_id = str(
-                msg.get("Thread-Index")
-                or msg.get("References")
-                or msg.get("In-Reply-To")
-                or ""
-            )
+        if self.sender_domains:
+            domains = tuple(d.lower().lstrip("@") for d in self.sender_domains)
+            senders = parse_addrs(headers.get("From"))
+            if not any(addr.lower().rpartition("@")[2] in domains for addr in senders):
+                return False
+
+        return True
+
+
+def _as_utc(dt: datetime) -> datetime:
+    if dt.tzinfo is None:
+        return dt.replace(tzinfo=timezone.utc)
+    return dt.astimezone(timezone.utc)
+
+
+def parse_header_block(msg_bytes: bytes):
+    """Parse only the header block of a raw message (everything before the first blank line)."""
+    ends = [i for i in (msg_bytes.find(b"\n\n"), msg_bytes.find(b"\r\n\r\n")) if i != -1]
+    header_bytes = msg_bytes[:min(ends)] if ends else msg_bytes
+    return BytesHeaderParser(policy=policy.compat32).parsebytes(header_bytes)
+
+
+# Fixed namespace so content-derived ids are identical across runs and hosts.
+EMAIL_ID_NAMESPACE = uuid.UUID("6f1c2a52-8a4e-4d1b-9c55-3f7d0e9b4a10")
+
+
+def _normalize_id_part(value) -> str:
+    return " ".join(str(value or "").split())
+
+
+def compute_email_id(message_id: str, subject: str, from_addr: list[str], sent_utc, body_text: str) -> str:
+    """Deterministic email id from Message-ID plus a normalized header/body hash.
+
+    Same idea as compute_email_hash in extract_pst_to_sqlite.py, but the
+    Message-ID alone is not trusted (some clients reuse or omit it) and
+    whitespace is collapsed so the HTML-to-text path does not change ids.
+    """
+    digest = hashlib.sha256()
+    for part in (
+        _normalize_id_part(subject),
+        ",".join(sorted(a.lower() for a in from_addr)),
+        sent_utc.isoformat(),
+        _normalize_id_part(body_text),
+    ):
+        digest.update(part.encode("utf-8", errors="ignore"))
+        digest.update(b"\x00")
+
+    return str(uuid.uuid5(EMAIL_ID_NAMESPACE, f"{message_id.strip()}|{digest.hexdigest()}"))
+
+
+class AttachmentStore:
+    """Content-addressed attachment blobs under ATTACH_DIR/blobs/ab/cd/<sha256>.
+
+    Every distinct payload is written once; duplicates (the same PDF
+    forwarded hundreds of times) only get another attachments row pointing
+    at the existing blob. Writes run on a small background I/O pool so
+    parsing does not wait on the disk.
+    """
+
+    def __init__(self, root=None, io_workers: int = ATTACH_IO_WORKERS):
+        self.root = Path(root or Path(ATTACH_DIR) / "blobs")
+        self.executor = ThreadPoolExecutor(max_workers=max(1, io_workers))
+        self.known = set()
+        self.pending = []
+        self.pending_bytes = 0
+        self.lock = threading.Lock()
+
+    def blob_path(self, sha256: str) -> Path:
+        return self.root / sha256[:2] / sha256[2:4] / sha256
+
+    def _write(self, path: Path, data: bytes):
+        if path.exists():
+            return
+        ensure_dir(path.parent)
+        tmp = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp.write_bytes(data)
+        os.replace(tmp, path)
+
+    def put(self, sha256: str, data: bytes) -> str:
+        path = self.blob_path(sha256)
+        with self.lock:
+            if sha256 not in self.known:
+                self.known.add(sha256)
+                self.pending.append(self.executor.submit(self._write, path, data))
+                self.pending_bytes += len(data)
+        return str(path)
+
+    def take_pending(self) -> list:
+        """Hand over the writes queued since the last call."""
+        with self.lock:
+            pending, self.pending = self.pending, []
+            self.pending_bytes = 0
+        return pending
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+
+def wait_for_writes(futures) -> int:
+    """Wait for attachment writes; return how many failed."""
+    failed = 0
+    for future in futures:
+        try:
+            future.result()
+        except Exception:
+            failed += 1
+    return failed
+
+
+def message_to_rows(msg, folder_name: str, attachment_store: AttachmentStore | None = None):
+    """Convert a parsed message into one emails row and its attachment rows.
+
+    Returns (None, []) for messages without subject and body. Attachment
+    payloads go to attachment_store when it is given.
+    """
+    message_id = str((msg.get("Message-ID") or msg.get("Message-Id") or "").strip())
+    subject = str(decode_mime(msg.get("Subject", "")) or "")
+
+    from_addr = parse_addrs(msg.get("From"))
+    to_addr = parse_addrs(msg.get("To"))
+    cc_addr = parse_addrs(msg.get("Cc"))
+    bcc_addr = parse_addrs(msg.get("Bcc"))
+
+    raw_date_value = msg.get("Date")
+    sent_raw = "" if raw_date_value is None else str(raw_date_value)
+    sent_utc = parse_date(raw_date_value)
+
+    thread_id = str(
+        msg.get("Thread-Index")
+        or msg.get("References")
+        or msg.get("In-Reply-To")
+        or ""
+    )
+
+    body_text, body_html = extract_body(msg)
+
+    if not body_text and body_html:
+        body_text = html_to_text(body_html)
+
+    body_text = "" if body_text is None else str(body_text)
+    body_html = "" if body_html is None else str(body_html)
+
+    if not body_text and not subject:
+        return None, []
+
+    if EMAIL_ID_MODE == "random":
+        stable_id = str(uuid.uuid4())
+    else:
+        stable_id = compute_email_id(message_id, subject, from_addr, sent_utc, body_text)
+
+    email_row = [
+        stable_id,
+        message_id,
+        thread_id,
+        subject,
+        from_addr,
+        to_addr,
+        cc_addr,
+        bcc_addr,
+        sent_utc,
+        sent_raw,
+        folder_name,
+        body_text,
+        body_html
+    ]
 
-            body_text, body_html = extract_body(msg)
+    attach_rows = []
 
-            if not body_text and body_html:
-                body_text = BeautifulSoup(body_html, "lxml").get_text("\n")
+    if msg.is_multipart():
+        for part in msg.walk():
+            if part.get_content_disposition() != "attachment":
+                continue
 
-            body_text = "" if body_text is None else str(body_text)
-            body_html = "" if body_html is None else str(body_html)
+            fname = part.get_filename() or "attachment"
+            fname = decode_mime(fname)
+            fname = fname.replace("\\", "_").replace("/", "_")
 
-            if not body_text and not subject:
+            data = part.get_payload(decode=True)
+            if not data:
                 continue
 
-            emails_rows.append([
+            size = len(data)
+            sha256 = hashlib.sha256(data).hexdigest()
+            fpath = ""
+
+            if attachment_store is not None:
+                fpath = attachment_store.put(sha256, data)
+
+            attach_rows.append([
                 stable_id,
-                message_id,
-                thread_id,
-                subject,
-                from_addr,
-                to_addr,
-                cc_addr,
-                bcc_addr,
-                sent_utc,
-                sent_raw,
-                folder_name,
-                body_text,
-                body_html
+                fname,
+                fpath,
+                int(size),
+                sha256
             ])
 
-            if msg.is_multipart():
-                for part in msg.walk():
-                    if part.get_content_disposition() != "attachment":
-                        continue
-
-                    fname = part.get_filename() or "attachment"
-                    fname = decode_mime(fname)
-                    fname = fname.replace("\\", "_").replace("/", "_")
-
-                    data = part.get_payload(decode=True)
-                    if not data:
-                        continue
-
-                    size = len(data)
-                    fpath = ""
-
-                    if SAVE_ATTACHMENTS:
-                        try:
-                            dest_dir = Path(ATTACH_DIR) / folder_name / stable_id
-                            ensure_dir(dest_dir)
-
-                            dest_fp = dest_dir / fname
-                            dest_fp.write_bytes(data)
-                            fpath = str(dest_fp)
-                        except Exception:
-                            pass
-
-                    attach_rows.append([
-                        stable_id,
-                        fname,
-                        fpath,
-                        int(size)
-                    ])
-
-            if len(emails_rows) >= BATCH:
-                client.insert(
-                    "mailkb.emails",
-                    emails_rows,
-                    column_names=[
-                        "id",
-                        "message_id",
-                        "thread_id",
-                        "subject",
-                        "from_addr",
-                        "to_addr",
-                        "cc_addr",
-                        "bcc_addr",
-                        "sent_at_utc",
-                        "sent_at_raw",
-                        "folder",
-                        "body_text",
-                        "body_html"
-                    ]
-                )
-                emails_rows.clear()
-
-            if len(attach_rows) >= BATCH:
-                client.insert(
-                    "mailkb.attachments",
-                    attach_rows,
-                    column_names=[
-                        "email_id",
-                        "filename",
-                        "path",
-                        "size_bytes"
-                    ]
+    return email_row, attach_rows
+
+
+class ImportCheckpoints:
+    """Per-range mbox import progress, kept in a local SQLite file.
+
+    One row per (path, range_start): the byte range it covers, the size and
+    mtime the mailbox had when the range was planned, and how far inserts
+    into ClickHouse have been committed.
+    """
+
+    def __init__(self, db_path=IMPORT_STATE_DB):
+        self.conn = sqlite3.connect(str(db_path), timeout=60, check_same_thread=False)
+        self.conn.execute("""
+        CREATE TABLE IF NOT EXISTS mbox_checkpoints (
+            path TEXT,
+            range_start INTEGER,
+            range_end INTEGER,
+            size INTEGER,
+            mtime_ns INTEGER,
+            committed_offset INTEGER,
+            messages INTEGER,
+            updated_at TEXT,
+            PRIMARY KEY (path, range_start)
+        )
+        """)
+        self.conn.commit()
+
+    def load(self, path) -> list[tuple]:
+        return self.conn.execute(
+            """
+            SELECT range_start, range_end, size, mtime_ns, committed_offset
+            FROM mbox_checkpoints
+            WHERE path = ?
+            ORDER BY range_start
+            """,
+            (str(path),)
+        ).fetchall()
+
+    def reset(self, path):
+        self.conn.execute("DELETE FROM mbox_checkpoints WHERE path = ?", (str(path),))
+        self.conn.commit()
+
+    def add_range(self, path, start: int, end: int):
+        self.conn.execute(
+            """
+            INSERT OR REPLACE INTO mbox_checkpoints
+            (path, range_start, range_end, size, mtime_ns, committed_offset, messages, updated_at)
+            VALUES (?, ?, ?, 0, 0, ?, 0, ?)
+            """,
+            (str(path), start, end, start, datetime.utcnow().isoformat())
+        )
+        self.conn.commit()
+
+    def touch(self, path, size: int, mtime_ns: int):
+        self.conn.execute(
+            "UPDATE mbox_checkpoints SET size = ?, mtime_ns = ? WHERE path = ?",
+            (size, mtime_ns, str(path))
+        )
+        self.conn.commit()
+
+    def commit(self, path, range_start: int, offset: int, messages: int):
+        self.conn.execute(
+            """
+            UPDATE mbox_checkpoints
+            SET committed_offset = ?, messages = messages + ?, updated_at = ?
+            WHERE path = ? AND range_start = ?
+            """,
+            (offset, messages, datetime.utcnow().isoformat(), str(path), range_start)
+        )
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+def plan_mbox_parts(mbox_path, part_bytes: int, checkpoints: ImportCheckpoints) -> list[tuple]:
+    """Return the (path, range_start, resume_from, end) parts still to import.
+
+    Committed ranges of an unchanged mailbox are skipped. A mailbox that
+    only grew (new messages appended) keeps its ranges and gets a new one
+    for the tail; a mailbox that shrank or was rewritten in place starts
+    over from byte 0.
+    """
+    st = os.stat(mbox_path)
+    rows = checkpoints.load(mbox_path)
+
+    if rows:
+        size, mtime_ns = rows[0][2], rows[0][3]
+        rewritten = st.st_size < size or (st.st_size == size and st.st_mtime_ns != mtime_ns)
+        if rewritten:
+            checkpoints.reset(mbox_path)
+            rows = []
+
+    parts = [
+        (mbox_path, range_start, committed, range_end)
+        for range_start, range_end, _, _, committed in rows
+        if committed < range_end
+    ]
+
+    covered = max((row[1] for row in rows), default=0)
+    if st.st_size > covered:
+        for start, end in split_mbox_ranges(mbox_path, part_bytes, covered):
+            checkpoints.add_range(mbox_path, start, end)
+            parts.append((mbox_path, start, start, end))
+
+    checkpoints.touch(mbox_path, st.st_size, st.st_mtime_ns)
+    return parts
+
+
+# Shared across import workers so --max-emails caps the whole run,
+# not each mailbox separately. Set by _init_import_worker.
+_import_counter = None
+
+
+def _init_import_worker(counter):
+    global _import_counter
+    _import_counter = counter
+
+
+def _take_import_slot(max_emails: int) -> bool:
+    with _import_counter.get_lock():
+        if max_emails > 0 and _import_counter.value >= max_emails:
+            return False
+        _import_counter.value += 1
+        return True
+
+
+def _email_row_bytes(row) -> int:
+    """Rough in-memory size of an emails row, used to size insert batches."""
+    size = 0
+    for value in row:
+        if isinstance(value, str):
+            size += len(value)
+        elif isinstance(value, list):
+            size += sum(len(v) for v in value)
+    return size
+
+
+class _BatchCommitTracker:
+    """Moves a range checkpoint forward as insert workers finish batches.
+
+    Batches may complete out of order with several insert workers, so the
+    checkpoint only advances over the contiguous prefix of finished batches.
+    """
+
+    def __init__(self, checkpoints: ImportCheckpoints, mbox_path, range_start: int, stats: dict):
+        self.checkpoints = checkpoints
+        self.mbox_path = mbox_path
+        self.range_start = range_start
+        self.stats = stats
+        self.lock = threading.Lock()
+        self.next_seq = 0
+        self.finished = {}
+
+    def complete(self, seq: int, next_offset: int, messages: int, emails: int, attachments: int):
+        with self.lock:
+            self.stats["emails"] += emails
+            self.stats["attachments"] += attachments
+            self.finished[seq] = (next_offset, messages)
+
+            commit_offset = None
+            commit_messages = 0
+            while self.next_seq in self.finished:
+                commit_offset, batch_messages = self.finished.pop(self.next_seq)
+                commit_messages += batch_messages
+                self.next_seq += 1
+
+            if commit_offset is not None:
+                self.checkpoints.commit(self.mbox_path, self.range_start, commit_offset, commit_messages)
+
+
+def _insert_worker(
+    batches: queue.Queue,
+    tracker: _BatchCommitTracker,
+    insert_stats: InsertStats,
+    errors: list,
+):
+    # One client per thread: clickhouse-connect sessions do not allow
+    # concurrent queries on the same client.
+    try:
+        client = create_clickhouse_client()
+    except Exception as e:
+        errors.append(e)
+
+    while True:
+        item = batches.get()
+        if item is None:
+            return
+        if errors:
+            # Keep draining so the producer never blocks on a full queue.
+            continue
+
+        seq, emails_rows, attach_rows, writes, next_offset, messages = item
+        try:
+            # The checkpoint must not pass a message whose blobs are not on disk yet.
+            failed = wait_for_writes(writes)
+            if failed:
+                print(f"[import] {failed} attachment writes failed")
+
+            bulk_insert(
+                client, "mailkb.emails", emails_rows, EMAIL_COLUMNS,
+                async_insert=CH_ASYNC_INSERT, stats=insert_stats,
+            )
+            bulk_insert(
+                client, "mailkb.attachments", attach_rows, ATTACH_COLUMNS,
+                async_insert=CH_ASYNC_INSERT, stats=insert_stats,
+            )
+            tracker.complete(seq, next_offset, messages, len(emails_rows), len(attach_rows))
+        except Exception as e:
+            errors.append(e)
+
+
+def _put_batch(batches: queue.Queue, item, errors: list):
+    """Queue a batch for the insert workers; drop it once they have failed."""
+    while not errors:
+        try:
+            batches.put(item, timeout=1)
+            return
+        except queue.Full:
+            pass
+
+
+def _batch_bytes(batch_bytes: int, attachment_store: AttachmentStore | None) -> int:
+    """Email row bytes plus the attachment payloads still held for writing."""
+    return batch_bytes + (attachment_store.pending_bytes if attachment_store else 0)
+
+
+def import_mbox_part(
+    mbox_path,
+    range_start: int,
+    start: int,
+    end: int,
+    max_emails: int = 0,
+    show_progress: bool = True,
+    state_db=IMPORT_STATE_DB,
+    header_filter: ImportFilter | None = None,
+) -> dict:
+    """Parse a byte range of one mbox file and insert its rows into ClickHouse.
+
+    Reading starts at start (the committed offset of the range that begins
+    at range_start). Parsing stays on this thread; finished batches go through
+    a bounded queue to IMPORT_INSERT_WORKERS insert threads, and the checkpoint
+    is moved to the first message not yet inserted after each batch lands.
+
+    Runs either in the main process or inside an import worker process,
+    so it only returns plain counters for the caller to report.
+    """
+    import email
+    from email import policy as _policy
+
+    checkpoints = ImportCheckpoints(state_db)
+    folder_name = mbox_folder_name(mbox_path)
+
+    stats = {
+        "file": str(mbox_path),
+        "range": (start, end),
+        "messages": 0,
+        "filtered": 0,
+        "emails": 0,
+        "attachments": 0,
+        "bytes": 0,
+        "seconds": 0.0,
+    }
+    started = time.time()
+
+    cache_before = header_cache_counters()
+
+    tracker = _BatchCommitTracker(checkpoints, mbox_path, range_start, stats)
+    attachment_store = AttachmentStore() if SAVE_ATTACHMENTS else None
+    insert_stats = InsertStats()
+    batches = queue.Queue(maxsize=IMPORT_QUEUE_SIZE)
+    errors = []
+    inserters = [
+        threading.Thread(
+            target=_insert_worker,
+            args=(batches, tracker, insert_stats, errors),
+            daemon=True,
+        )
+        for _ in range(max(1, IMPORT_INSERT_WORKERS))
+    ]
+    for t in inserters:
+        t.start()
+
+    emails_rows = []
+    attach_rows = []
+    batch_bytes = 0
+    batch_messages = 0
+    seq = 0
+    next_offset = start
+    finished = True
+
+    def flush():
+        nonlocal emails_rows, attach_rows, batch_bytes, batch_messages, seq
+
+        writes = attachment_store.take_pending() if attachment_store else []
+        _put_batch(batches, (seq, emails_rows, attach_rows, writes, next_offset, batch_messages), errors)
+        seq += 1
+        emails_rows = []
+        attach_rows = []
+        batch_bytes = 0
+        batch_messages = 0
+
+    messages = _iter_mbox_raw(str(mbox_path), start, end)
+    if show_progress:
+        messages = tqdm(messages, desc=folder_name)
+
+    try:
+        for next_offset_candidate, msg_bytes in messages:
+            if errors:
+                break
+
+            # Cheap header-only parse first: messages outside the filter never
+            # get their MIME body and attachments decoded.
+            if header_filter is not None and not header_filter.matches_headers(
+                parse_header_block(msg_bytes)
+            ):
+                stats["filtered"] += 1
+                batch_messages += 1
+                next_offset = next_offset_candidate
+                continue
+
+            if not _take_import_slot(max_emails):
+                finished = False
+                break
+            stats["messages"] += 1
+            batch_messages += 1
+            next_offset = next_offset_candidate
+
+            msg = email.message_from_bytes(msg_bytes, policy=_policy.compat32)
+            email_row, msg_attach_rows = message_to_rows(msg, folder_name, attachment_store)
+            if email_row is not None:
+                emails_rows.append(email_row)
+                attach_rows.extend(msg_attach_rows)
+                batch_bytes += _email_row_bytes(email_row)
+
+            if _batch_bytes(batch_bytes, attachment_store) >= IMPORT_BATCH_BYTES or len(emails_rows) >= BATCH:
+                flush()
+
+        if finished and not errors:
+            next_offset = end
+        flush()
+    finally:
+        for _ in inserters:
+            batches.put(None)
+        for t in inserters:
+            t.join()
+        if attachment_store:
+            attachment_store.close()
+        checkpoints.close()
+
+    if errors:
+        raise errors[0]
+
+    # a run capped by max_emails stops early: count only the bytes read
+    stats["bytes"] = next_offset - start
+    stats["insert"] = insert_stats.as_dict()
+    stats["header_cache"] = header_cache_delta(cache_before)
+    stats["seconds"] = time.time() - started
+    return stats
+
+
+def print_import_report(results: list[dict], elapsed: float):
+    messages = sum(r["messages"] for r in results)
+    filtered = sum(r.get("filtered", 0) for r in results)
+    emails = sum(r["emails"] for r in results)
+    attachments = sum(r["attachments"] for r in results)
+    mbytes = sum(r["bytes"] for r in results) / (1024 * 1024)
+    elapsed = max(elapsed, 1e-6)
+    files = len({r["file"] for r in results})
+
+    insert_stats = InsertStats()
+    cache_counters = {name: (0, 0) for name in HEADER_CACHES}
+    for r in results:
+        insert_stats.merge(r.get("insert", {}))
+        for name, (hits, misses) in r.get("header_cache", {}).items():
+            prev_hits, prev_misses = cache_counters[name]
+            cache_counters[name] = (prev_hits + hits, prev_misses + misses)
+
+    print(
+        f"[import] DONE: files={files}, parts={len(results)}, messages={messages}, "
+        f"filtered={filtered}, "
+        f"emails={emails}, attachments={attachments}, "
+        f"elapsed={elapsed:.1f}s, "
+        f"msgs/s={messages / elapsed:.1f}, MB/s={mbytes / elapsed:.2f}"
+    )
+    print(f"[import] {insert_stats.summary()}")
+    print(f"[import] {format_header_cache(cache_counters)}")
+
+
+def import_mbox_to_clickhouse(
+    max_emails: int = 0,
+    workers: int = IMPORT_WORKERS,
+    resume: bool = True,
+    header_filter: ImportFilter | None = None,
+):
+    ensure_dir(ATTACH_DIR)
+
+    mbox_files = list(iter_mbox_files(MBOX_DIR))
+    part_bytes = MBOX_SPLIT_BYTES if workers > 1 else 0
+
+    # A filtered import is a one-off slice: it must not mark ranges as
+    # committed for the regular import, so its checkpoints stay in memory.
+    state_db = IMPORT_STATE_DB
+    if header_filter is not None and header_filter.is_active():
+        mbox_files = [p for p in mbox_files if header_filter.matches_folder(mbox_folder_name(p))]
+        state_db = ":memory:"
+    else:
+        header_filter = None
+
+    checkpoints = ImportCheckpoints(state_db)
+    parts = []
+    for mbox_path in mbox_files:
+        if not resume:
+            checkpoints.reset(mbox_path)
+        file_parts = plan_mbox_parts(mbox_path, part_bytes, checkpoints)
+        if not file_parts:
+            print("Unchanged, skipping:", mbox_path)
+        parts.extend(file_parts)
+    checkpoints.close()
+
+    counter = multiprocessing.Value("q", 0)
+    results = []
+    start = time.time()
+
+    if workers <= 1:
+        _init_import_worker(counter)
+        for mbox_path, range_start, resume_from, end in parts:
+            if max_emails > 0 and counter.value >= max_emails:
+                break
+            print("Processing:", mbox_path)
+            results.append(import_mbox_part(
+                mbox_path, range_start, resume_from, end, max_emails,
+                state_db=state_db, header_filter=header_filter,
+            ))
+    else:
+        # Largest parts first so a giant range does not start last
+        # and leave the other workers idle at the end of the run.
+        parts.sort(key=lambda p: p[3] - p[2], reverse=True)
+        print(f"[import] {len(mbox_files)} mbox files, {len(parts)} parts, workers={workers}")
+
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_init_import_worker,
+            initargs=(counter,),
+        ) as executor:
+            futures = [
+                executor.submit(
+                    import_mbox_part,
+                    mbox_path, range_start, resume_from, end, max_emails, False,
+                    state_db, header_filter,
                 )
-                attach_rows.clear()
-
-    if emails_rows:
-        client.insert(
-            "mailkb.emails",
-            emails_rows,
-            column_names=[
-                "id",
-                "message_id",
-                "thread_id",
-                "subject",
-                "from_addr",
-                "to_addr",
-                "cc_addr",
-                "bcc_addr",
-                "sent_at_utc",
-                "sent_at_raw",
-                "folder",
-                "body_text",
-                "body_html"
+                for mbox_path, range_start, resume_from, end in parts
             ]
+
+            for future in as_completed(futures):
+                stats = future.result()
+                results.append(stats)
+                range_start, range_end = stats["range"]
+                print(
+                    f"[import] {len(results)}/{len(parts)} {stats['file']} "
+                    f"[{range_start}:{range_end}]: "
+                    f"messages={stats['messages']}, emails={stats['emails']}, "
+                    f"attachments={stats['attachments']}, {stats['seconds']:.1f}s"
+                )
+
+    print_import_report(results, time.time() - start)
+    return results
+
+
+# =========================================================
+# 1b. import PST -> ClickHouse
+# =========================================================
+
+# Same filters as work/scripts/extract_pst_to_sqlite.py.
+PST_IGNORE_FOLDERS = {"conversation history", "skype", "teams"}
+PST_MIN_BODY_CHARS = 30
+
+# A PST is tracked as a single "range" in mbox_checkpoints whose offsets
+# count messages instead of bytes; a finished file is committed at this end.
+PST_RANGE_END = 2 ** 62
+
+PST_SPILL_SCHEMA = """
+CREATE TABLE IF NOT EXISTS emails(
+  id TEXT PRIMARY KEY,
+  message_id TEXT,
+  subject TEXT,
+  from_addr_json TEXT,
+  to_addr_json TEXT,
+  cc_addr_json TEXT,
+  bcc_addr_json TEXT,
+  sent_at_utc TEXT,
+  sent_at_raw TEXT,
+  folder TEXT,
+  source_pst TEXT,
+  body_len INTEGER,
+  body_text TEXT,
+  body_html TEXT
+);
+
+CREATE TABLE IF NOT EXISTS attachments(
+  email_id TEXT,
+  filename TEXT,
+  path TEXT,
+  size_bytes INTEGER
+);
+"""
+
+
+def iter_pst_files(base):
+    for pst_path in Path(base).rglob("*.pst"):
+        if pst_path.is_file():
+            yield pst_path
+
+
+def _pst_text(value) -> str:
+    if value is None:
+        return ""
+    if isinstance(value, bytes):
+        return value.decode("utf-8", errors="replace")
+    return str(value)
+
+
+def pst_message_to_rows(msg, header_parser, attachment_store: AttachmentStore | None = None):
+    """Convert a libratom/pypff message into one emails row and its attachment rows.
+
+    Returns (None, []) for messages in PST_IGNORE_FOLDERS and for chat-like
+    bodies, the same messages extract_pst_to_sqlite.py leaves out.
+    """
+    folder = _pst_text(getattr(msg, "folder_name", None)) or "unknown"
+    if folder.lower() in PST_IGNORE_FOLDERS:
+        return None, []
+
+    body_text = _pst_text(getattr(msg, "plain_text_body", None))
+    body_html = _pst_text(getattr(msg, "html_body", None))
+    if not body_text and body_html:
+        body_text = html_to_text(body_html)
+
+    if len(body_text.strip()) < PST_MIN_BODY_CHARS:
+        return None, []
+
+    headers = header_parser.parsestr(_pst_text(getattr(msg, "transport_headers", None)))
+
+    message_id = str((headers.get("Message-ID") or headers.get("Message-Id") or "").strip())
+    subject = str(decode_mime(headers.get("Subject", "")) or "").strip()
+
+    from_addr = parse_addrs(headers.get("From"))
+    to_addr = parse_addrs(headers.get("To"))
+    cc_addr = parse_addrs(headers.get("Cc"))
+    bcc_addr = parse_addrs(headers.get("Bcc"))
+
+    raw_date_value = headers.get("Date")
+    sent_raw = "" if raw_date_value is None else str(raw_date_value)
+    sent_utc = parse_date(raw_date_value)
+
+    thread_id = str(
+        headers.get("Thread-Index")
+        or headers.get("References")
+        or headers.get("In-Reply-To")
+        or ""
+    )
+
+    if EMAIL_ID_MODE == "random":
+        stable_id = str(uuid.uuid4())
+    else:
+        stable_id = compute_email_id(message_id, subject, from_addr, sent_utc, body_text)
+
+    email_row = [
+        stable_id,
+        message_id,
+        thread_id,
+        subject,
+        from_addr,
+        to_addr,
+        cc_addr,
+        bcc_addr,
+        sent_utc,
+        sent_raw,
+        folder,
+        body_text,
+        body_html
+    ]
+
+    attach_rows = []
+
+    for att in getattr(msg, "attachments", None) or []:
+        fname = _pst_text(getattr(att, "name", None)) or f"att_{att.identifier}"
+        fname = fname.replace("\\", "_").replace("/", "_")
+
+        size = int(getattr(att, "size", 0) or 0)
+        try:
+            data = att.read_buffer(size) if size else att.read()
+        except Exception:
+            data = None
+        if not data:
+            continue
+
+        sha256 = hashlib.sha256(data).hexdigest()
+        fpath = ""
+
+        if attachment_store is not None:
+            fpath = attachment_store.put(sha256, data)
+
+        attach_rows.append([
+            stable_id,
+            fname,
+            fpath,
+            len(data),
+            sha256
+        ])
+
+    return email_row, attach_rows
+
+
+def plan_pst_files(pst_files, checkpoints: ImportCheckpoints) -> list[tuple]:
+    """Return the (path, resume_from) PST files still to import.
+
+    resume_from is the number of messages already committed. A PST that
+    changed on disk since its checkpoint was written starts over.
+    """
+    plan = []
+    for pst_path in pst_files:
+        st = os.stat(pst_path)
+        rows = checkpoints.load(pst_path)
+
+        if rows and (rows[0][2], rows[0][3]) != (st.st_size, st.st_mtime_ns):
+            checkpoints.reset(pst_path)
+            rows = []
+
+        if not rows:
+            checkpoints.add_range(pst_path, 0, PST_RANGE_END)
+            checkpoints.touch(pst_path, st.st_size, st.st_mtime_ns)
+            committed = 0
+        else:
+            committed = rows[0][4]
+
+        if committed >= PST_RANGE_END:
+            print("Already imported, skipping:", pst_path)
+            continue
+        plan.append((pst_path, committed))
+
+    return plan
+
+
+def _spill_pst_rows(conn, source_pst: str, emails_rows: list, attach_rows: list):
+    conn.executemany(
+        """
+        INSERT OR IGNORE INTO emails
+        (id,message_id,subject,from_addr_json,to_addr_json,cc_addr_json,bcc_addr_json,
+         sent_at_utc,sent_at_raw,folder,source_pst,body_len,body_text,body_html)
+        VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?)
+        """,
+        [
+            (
+                r[0], r[1], r[3],
+                json.dumps(r[4], ensure_ascii=False),
+                json.dumps(r[5], ensure_ascii=False),
+                json.dumps(r[6], ensure_ascii=False),
+                json.dumps(r[7], ensure_ascii=False),
+                r[8].isoformat(), r[9], r[10], source_pst,
+                len(r[11]), r[11], r[12],
+            )
+            for r in emails_rows
+        ]
+    )
+    conn.executemany(
+        "INSERT INTO attachments (email_id,filename,path,size_bytes) VALUES (?,?,?,?)",
+        [tuple(r[:4]) for r in attach_rows]
+    )
+    conn.commit()
+
+
+def import_pst_file(
+    pst_path,
+    start: int = 0,
+    max_emails: int = 0,
+    show_progress: bool = True,
+    state_db=IMPORT_STATE_DB,
+    spill_db: str = PST_SPILL_DB,
+) -> dict:
+    """Stream one PST straight into mailkb.emails / mailkb.attachments.
+
+    The first start messages were committed by an earlier run and are
+    skipped. Batches go through the same insert threads and checkpoint
+    tracker as the mbox import, with message counts as offsets. With
+    spill_db set, every batch is also written to a SQLite file in the
+    extract_pst_to_sqlite.py layout.
+    """
+    from email.parser import HeaderParser
+
+    from libratom.lib.core import open_mail_archive
+
+    checkpoints = ImportCheckpoints(state_db)
+    spill = None
+    if spill_db:
+        spill = sqlite3.connect(str(spill_db), timeout=60)
+        spill.execute("PRAGMA journal_mode=WAL")
+        spill.executescript(PST_SPILL_SCHEMA)
+
+    stats = {
+        "file": str(pst_path),
+        "range": (start, None),
+        "messages": 0,
+        "filtered": 0,
+        "emails": 0,
+        "attachments": 0,
+        "bytes": os.stat(pst_path).st_size if start == 0 else 0,
+        "seconds": 0.0,
+    }
+    started = time.time()
+
+    cache_before = header_cache_counters()
+    header_parser = HeaderParser()
+
+    tracker = _BatchCommitTracker(checkpoints, pst_path, 0, stats)
+    attachment_store = AttachmentStore() if SAVE_ATTACHMENTS else None
+    insert_stats = InsertStats()
+    batches = queue.Queue(maxsize=IMPORT_QUEUE_SIZE)
+    errors = []
+    inserters = [
+        threading.Thread(
+            target=_insert_worker,
+            args=(batches, tracker, insert_stats, errors),
+            daemon=True,
         )
+        for _ in range(max(1, IMPORT_INSERT_WORKERS))
+    ]
+    for t in inserters:
+        t.start()
+
+    emails_rows = []
+    attach_rows = []
+    batch_bytes = 0
+    batch_messages = 0
+    seq = 0
+    consumed = start
+    finished = True
+
+    def flush():
+        nonlocal emails_rows, attach_rows, batch_bytes, batch_messages, seq
+
+        if spill is not None:
+            _spill_pst_rows(spill, Path(pst_path).name, emails_rows, attach_rows)
+        writes = attachment_store.take_pending() if attachment_store else []
+        _put_batch(batches, (seq, emails_rows, attach_rows, writes, consumed, batch_messages), errors)
+        seq += 1
+        emails_rows = []
+        attach_rows = []
+        batch_bytes = 0
+        batch_messages = 0
+
+    try:
+        with open_mail_archive(Path(pst_path)) as archive:
+            messages = archive.messages()
+            if show_progress:
+                messages = tqdm(messages, desc=Path(pst_path).name)
+
+            for i, msg in enumerate(messages):
+                if i < start:
+                    continue
+                if errors:
+                    break
+                if not _take_import_slot(max_emails):
+                    finished = False
+                    break
+
+                stats["messages"] += 1
+                batch_messages += 1
+                consumed = i + 1
+
+                email_row, msg_attach_rows = pst_message_to_rows(msg, header_parser, attachment_store)
+                if email_row is None:
+                    stats["filtered"] += 1
+                else:
+                    emails_rows.append(email_row)
+                    attach_rows.extend(msg_attach_rows)
+                    batch_bytes += _email_row_bytes(email_row)
+
+                # Row count alone would never flush a long run of filtered messages.
+                if (
+                    _batch_bytes(batch_bytes, attachment_store) >= IMPORT_BATCH_BYTES
+                    or len(emails_rows) >= BATCH
+                    or batch_messages >= BATCH * 10
+                ):
+                    flush()
+
+        if finished and not errors:
+            consumed = PST_RANGE_END
+        flush()
+    finally:
+        for _ in inserters:
+            batches.put(None)
+        for t in inserters:
+            t.join()
+        if attachment_store:
+            attachment_store.close()
+        if spill is not None:
+            spill.close()
+        checkpoints.close()
+
+    if errors:
+        raise errors[0]
+
+    stats["insert"] = insert_stats.as_dict()
+    stats["header_cache"] = header_cache_delta(cache_before)
+    stats["seconds"] = time.time() - started
+    return stats
+
+
+def import_pst_to_clickhouse(
+    max_emails: int = 0,
+    workers: int = IMPORT_WORKERS,
+    resume: bool = True,
+    spill_db: str = PST_SPILL_DB,
+):
+    """Import every *.pst under PST_DIR, one worker process per file."""
+    try:
+        import libratom  # noqa: F401
+    except ImportError as e:
+        raise RuntimeError("PST import needs libratom: pip install libratom") from e
+
+    ensure_dir(ATTACH_DIR)
+
+    pst_files = list(iter_pst_files(PST_DIR))
 
-    if attach_rows:
-        client.insert(
-            "mailkb.attachments",
-            attach_rows,
-            column_names=[
-                "email_id",
-                "filename",
-                "path",
-                "size_bytes"
+    checkpoints = ImportCheckpoints(IMPORT_STATE_DB)
+    if not resume:
+        for pst_path in pst_files:
+            checkpoints.reset(pst_path)
+    plan = plan_pst_files(pst_files, checkpoints)
+    checkpoints.close()
+
+    counter = multiprocessing.Value("q", 0)
+    results = []
+    start = time.time()
+
+    if workers <= 1:
+        _init_import_worker(counter)
+        for pst_path, resume_from in plan:
+            if max_emails > 0 and counter.value >= max_emails:
+                break
+            print("Processing:", pst_path)
+            results.append(import_pst_file(
+                pst_path, resume_from, max_emails, spill_db=spill_db,
+            ))
+    else:
+        plan.sort(key=lambda p: os.stat(p[0]).st_size, reverse=True)
+        print(f"[import] {len(plan)} pst files, workers={workers}")
+
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_init_import_worker,
+            initargs=(counter,),
+        ) as executor:
+            futures = [
+                executor.submit(
+                    import_pst_file,
+                    pst_path, resume_from, max_emails, False, IMPORT_STATE_DB, spill_db,
+                )
+                for pst_path, resume_from in plan
             ]
-        )
+
+            for future in as_completed(futures):
+                stats = future.result()
+                results.append(stats)
+                print(
+                    f"[import] {len(results)}/{len(plan)} {stats['file']}: "
+                    f"messages={stats['messages']}, emails={stats['emails']}, "
+                    f"attachments={stats['attachments']}, {stats['seconds']:.1f}s"
+                )
+
+    print_import_report(results, time.time() - start)
+    return results
 
 
 # =========================================================
 # 2. dedup emails
 # =========================================================
 
+class ContainmentIndex:
+    """Answers "is this body a substring of a kept body" without scanning them all.
+
+    Every full line of every kept body is indexed. If body occurs inside a
+    kept body, each of its interior lines (the segments between its first
+    and last newline) is a full line of that kept body, so intersecting the
+    kept bodies of those lines yields a small candidate set that is then
+    checked with a plain substring test. Bodies with fewer than two
+    newlines have no interior line and fall back to scanning.
+    """
+
+    def __init__(self):
+        self.bodies = []
+        self.lines = {}
+
+    def add(self, body: str):
+        idx = len(self.bodies)
+        self.bodies.append(body)
+        for line in set(body.split("\n")):
+            self.lines.setdefault(line, []).append(idx)
+
+    def contains(self, body: str) -> bool:
+        parts = body.split("\n")
+        if len(parts) < 3:
+            return any(body in kept for kept in self.bodies)
+
+        postings = []
+        for line in set(parts[1:-1]):
+            ids = self.lines.get(line)
+            if ids is None:
+                return False
+            postings.append(ids)
+
+        # Start from the rarest line; stop narrowing once a few candidates remain.
+        postings.sort(key=len)
+        candidates = set(postings[0])
+        for ids in postings[1:]:
+            if len(candidates) <= 4:
+                break
+            candidates.intersection_update(ids)
+            if not candidates:
+                return False
+
+        return any(body in self.bodies[idx] for idx in sorted(candidates))
+
+
+def dedup_bodies(bodies: list[str]) -> list[int]:
+    """Positions of the bodies to keep, in order.
+
+    bodies must be sorted longest first; a body is dropped when it is a
+    substring of a body kept before it.
+    """
+    index = ContainmentIndex()
+    keep = []
+
+    for pos, body in enumerate(bodies):
+        if not index.contains(body):
+            index.add(body)
+            keep.append(pos)
+
+    return keep
+
+
 def dedup_thread(df_thread):
     rows = df_thread.sort_values(
         by="body_text",
@@ -345,70 +1650,519 @@ def dedup_thread(df_thread):
         ascending=False
     )
 
-    kept = []
+    keep = dedup_bodies(rows["body_text"].tolist())
 
-    for _, row in rows.iterrows():
-        body = row["body_text"]
-        duplicate = False
+    return rows.iloc[keep]
 
-        for k in kept:
-            if body in k["body_text"]:
-                duplicate = True
-                break
 
-        if not duplicate:
-            kept.append(row)
+def _dedup_packed(text: str, offsets: np.ndarray, groups: np.ndarray) -> np.ndarray:
+    """Kept row positions of packed threads.
 
-    return pd.DataFrame(kept)
+    Bodies are text[offsets[i]:offsets[i + 1]]; thread j is rows
+    groups[j]:groups[j + 1], in sent_at order. Within a thread bodies are
+    checked longest first (stable, so the earliest of equal lengths wins).
+    """
+    lengths = np.diff(offsets)
+    keep = []
 
+    for start, end in zip(groups[:-1].tolist(), groups[1:].tolist()):
+        order = start + np.argsort(-lengths[start:end], kind="stable")
+        bodies = [text[offsets[i]:offsets[i + 1]] for i in order.tolist()]
+        keep.extend(order[dedup_bodies(bodies)].tolist())
 
-def deduplicate_emails():
-    client = get_clickhouse_client()
-    offset = 0
+    return np.array(sorted(keep), dtype=np.int64)
 
-    while True:
-        query = f"""
+
+def dedup_frame(df, pool=None, shards: int = 1) -> np.ndarray:
+    """Kept row positions of df, which must be sorted by thread_key.
+
+    Bodies are shipped to pool workers as one str plus int64 offsets per
+    shard (a few pickled buffers instead of per-row objects); shards are
+    whole threads balanced by body size.
+    """
+    n = len(df)
+    if n == 0:
+        return np.empty(0, dtype=np.int64)
+
+    keys = df["thread_key"].to_numpy()
+    groups = np.concatenate(([0], np.flatnonzero(keys[1:] != keys[:-1]) + 1, [n]))
+
+    bodies = df["body_text"].tolist()
+    offsets = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.fromiter(map(len, bodies), dtype=np.int64, count=n), out=offsets[1:])
+    text = "".join(bodies)
+
+    if pool is None or shards <= 1 or len(groups) <= 2:
+        return _dedup_packed(text, offsets, groups)
+
+    # cut at thread boundaries closest to equal shares of the text
+    targets = offsets[-1] * np.arange(1, shards) / shards
+    cuts = np.unique(np.concatenate(([0], np.searchsorted(offsets[groups], targets), [len(groups) - 1])))
+
+    futures = []
+    for a, b in zip(cuts[:-1].tolist(), cuts[1:].tolist()):
+        if a == b:
+            continue
+        lo, hi = groups[a], groups[b]
+        futures.append((lo, pool.submit(
+            _dedup_packed,
+            text[offsets[lo]:offsets[hi]],
+            offsets[lo:hi + 1] - offsets[lo],
+            groups[a:b + 1] - lo,
+        )))
+
+    return np.concatenate([lo + future.result() for lo, future in futures])
+
+
+# Rows of emails_unique are versioned per run: a thread is replaced by
+# inserting its kept rows and tombstones (is_deleted=1) for rows it no
+# longer keeps, all with the run's version, in one insert. Readers use FINAL.
+UNIQUE_COLUMNS = [
+    "id",
+    "thread_key",
+    "message_id",
+    "subject",
+    "from_addr",
+    "to_addr",
+    "sent_at_utc",
+    "folder",
+    "body_text",
+]
+TOMBSTONE_DEFAULTS = {
+    "message_id": "",
+    "subject": "",
+    "from_addr": [],
+    "to_addr": [],
+    "sent_at_utc": datetime(1970, 1, 1),
+    "folder": "",
+    "body_text": "",
+}
+
+
+def _touched_threads(since) -> tuple[str, dict]:
+    """SQL filter (and params) for threads with rows ingested at or after since."""
+    if since is None:
+        return "", {}
+    # >=: rows inserted in the same second as the last watermark are taken again
+    return """
+          AND thread_key IN (
+              SELECT thread_key FROM mailkb.emails WHERE ingested_at >= %(since)s
+          )""", {"since": since}
+
+
+def last_dedup_watermark(client):
+    """ingested_at watermark of the last finished dedup run, None before the first one."""
+    runs, watermark = client.query("""
+        SELECT count(), max(watermark) FROM mailkb.dedup_runs
+    """).result_rows[0]
+    return watermark if runs else None
+
+
+def plan_dedup_chunks(client, chunk_rows: int = CHUNK_SIZE, since=None) -> list[tuple[str, str, int]]:
+    """Pack whole threads into (first_key, last_key, rows) chunks of about chunk_rows rows.
+
+    Chunks are contiguous thread_key ranges, so every thread lands in
+    exactly one chunk; a thread bigger than chunk_rows gets a chunk of its own.
+    With since, only threads that received rows since then are planned.
+    """
+    touched, params = _touched_threads(since)
+    counts = client.query(f"""
+        SELECT thread_key, count()
+        FROM mailkb.emails
+        WHERE body_text IS NOT NULL{touched}
+        GROUP BY thread_key
+        ORDER BY thread_key
+    """, params).result_rows
+
+    chunks = []
+    first_key = None
+    rows = 0
+
+    for thread_key, n in counts:
+        if first_key is not None and rows + n > chunk_rows:
+            chunks.append((first_key, last_key, rows))
+            first_key = None
+            rows = 0
+        if first_key is None:
+            first_key = thread_key
+        last_key = thread_key
+        rows += n
+
+    if first_key is not None:
+        chunks.append((first_key, last_key, rows))
+
+    return chunks
+
+
+def dedup_chunk(
+    client,
+    first_key: str,
+    last_key: str,
+    insert_stats: InsertStats,
+    version: int = 0,
+    since=None,
+    pool=None,
+    shards: int = 1,
+) -> tuple[int, int, int]:
+    """Recompute the threads in [first_key, last_key]; return (loaded, kept, removed) rows.
+
+    loaded counts rows after the exact-duplicate collapse in ClickHouse;
+    removed counts emails_unique rows of these threads that were tombstoned.
+    """
+    touched, touched_params = _touched_threads(since)
+    params = {"first_key": first_key, "last_key": last_key, **touched_params}
+
+    # Exact copies (the same mail in Inbox, Sent and archive folders) are
+    # collapsed by ClickHouse: one row per thread_key and body hash (trimmed,
+    # CR dropped), taken from the earliest copy. Python only sees distinct
+    # bodies and handles the quoted-reply containment case.
+    df = client.query_df(f"""
         SELECT
-            id,
+            argMin(id, (sent_at_utc, id)) AS id,
             thread_key,
-            message_id,
-            subject,
-            from_addr,
-            to_addr,
-            sent_at_utc,
-            folder,
-            body_text
+            argMin(message_id, (sent_at_utc, id)) AS message_id,
+            argMin(subject, (sent_at_utc, id)) AS subject,
+            argMin(from_addr, (sent_at_utc, id)) AS from_addr,
+            argMin(to_addr, (sent_at_utc, id)) AS to_addr,
+            min(sent_at_utc) AS sent_at_utc,
+            argMin(folder, (sent_at_utc, id)) AS folder,
+            argMin(body_text, (sent_at_utc, id)) AS body_text
         FROM mailkb.emails
         WHERE body_text IS NOT NULL
+          AND thread_key >= %(first_key)s
+          AND thread_key <= %(last_key)s{touched}
+        GROUP BY
+            thread_key,
+            cityHash64(trimBoth(replaceAll(body_text, char(13), '')))
         ORDER BY thread_key, sent_at_utc
-        LIMIT {CHUNK_SIZE}
-        OFFSET {offset}
-        """
+    """, params)
+
+    existing = client.query(f"""
+        SELECT thread_key, id
+        FROM mailkb.emails_unique FINAL
+        WHERE thread_key >= %(first_key)s
+          AND thread_key <= %(last_key)s{touched}
+    """, params).result_rows
+
+    kept_rows = df.take(dedup_frame(df, pool, shards)) if not df.empty else df
+    columns = {c: kept_rows[c].tolist() if c in kept_rows else [] for c in UNIQUE_COLUMNS}
+    kept_ids = set(columns["id"])
+
+    kept = len(kept_ids)
+    stale = [(thread_key, eid) for thread_key, eid in existing if eid not in kept_ids]
+
+    for thread_key, eid in stale:
+        columns["id"].append(eid)
+        columns["thread_key"].append(thread_key)
+        for c, value in TOMBSTONE_DEFAULTS.items():
+            columns[c].append(value)
+
+    n_rows = len(columns["id"])
+    columns["version"] = [version] * n_rows
+    columns["is_deleted"] = [0] * kept + [1] * len(stale)
+
+    bulk_insert(
+        client,
+        "mailkb.emails_unique",
+        list(columns.values()),
+        list(columns),
+        columnar=True,
+        async_insert=CH_ASYNC_INSERT,
+        stats=insert_stats,
+    )
 
-        df = client.query_df(query)
+    return len(df), kept, len(stale)
 
-        if df.empty:
-            break
 
-        print("Loaded rows:", len(df))
+def deduplicate_emails(workers: int = DEDUP_WORKERS, full: bool = False, processes: int = DEDUP_PROCESSES):
+    """Dedup threads into emails_unique.
+
+    Incremental by default: only threads that received rows since the last
+    run's watermark are recomputed. full=True (or no previous run)
+    recomputes every thread. workers threads read and write chunks;
+    with processes > 1 the containment check runs in a process pool.
+    """
+    client = get_clickhouse_client()
+    insert_stats = InsertStats()
+
+    # The watermark is taken before planning, so rows arriving during the
+    # run are picked up by the next one.
+    watermark = client.query("SELECT max(ingested_at) FROM mailkb.emails").result_rows[0][0]
+    since = None if full else last_dedup_watermark(client)
+    mode = "full" if since is None else "incremental"
+    version = time.time_ns()
+
+    chunks = plan_dedup_chunks(client, CHUNK_SIZE, since)
+    print(f"[dedup] {mode} (since={since}), {len(chunks)} chunks, workers={workers}, processes={processes}")
+
+    local = threading.local()
+
+    def run_chunk(chunk):
+        # One client per thread: clickhouse-connect sessions do not allow
+        # concurrent queries on the same client.
+        if not hasattr(local, "client"):
+            local.client = client if workers <= 1 else create_clickhouse_client()
+        first_key, last_key, _ = chunk
+        return dedup_chunk(local.client, first_key, last_key, insert_stats, version, since, pool, processes)
+
+    rows = sum(c[2] for c in chunks)
+    loaded = kept = removed = 0
+
+    pool = ProcessPoolExecutor(max_workers=processes) if processes > 1 else None
+
+    with pool or nullcontext(), ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = {executor.submit(run_chunk, chunk): chunk for chunk in chunks}
+
+        for done, future in enumerate(as_completed(futures), 1):
+            chunk_loaded, chunk_kept, chunk_removed = future.result()
+            loaded += chunk_loaded
+            kept += chunk_kept
+            removed += chunk_removed
+            print(
+                f"[dedup] {done}/{len(chunks)}: rows={futures[future][2]}, "
+                f"distinct={chunk_loaded}, kept={chunk_kept}, removed={chunk_removed}"
+            )
+
+    bulk_insert(
+        client,
+        "mailkb.dedup_runs",
+        [[watermark], [mode], [len(chunks)], [rows]],
+        ["watermark", "mode", "chunks", "rows"],
+        columnar=True,
+    )
+
+    print(
+        f"[dedup] DONE: rows={rows}, distinct bodies loaded={loaded} "
+        f"(exact-duplicate collapse x{rows / max(loaded, 1):.1f}), kept={kept}, removed={removed}"
+    )
+    print(insert_stats.summary())
+
+
+# =========================================================
+# 2b. near-duplicates across threads (MinHash LSH)
+# =========================================================
+
+# permutation i hashes a shingle x as splitmix64(x ^ seed_i); plain
+# multiply-shift families are not min-wise independent enough for MinHash
+_MINHASH_SEED = 20240601
+_SHINGLE_MULT = np.uint64(0x9E3779B97F4A7C15)
+
 
-        result = []
+def minhash_seeds(num_perm: int = NEAR_DUP_NUM_PERM) -> np.ndarray:
+    return np.random.default_rng(_MINHASH_SEED).integers(0, 2**63, size=num_perm, dtype=np.uint64)
 
-        for thread_key, df_thread in df.groupby("thread_key"):
-            deduped = dedup_thread(df_thread)
-            result.append(deduped)
 
-        df_result = pd.concat(result)
-        rows = df_result.values.tolist()
+def _splitmix64(z: np.ndarray) -> np.ndarray:
+    z = z + np.uint64(0x9E3779B97F4A7C15)
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return z ^ (z >> np.uint64(31))
 
-        client.insert(
-            "mailkb.emails_unique",
-            rows,
-            column_names=df_result.columns.tolist()
+
+def shingle_hashes(text: str, k: int = NEAR_DUP_SHINGLE, min_words: int = NEAR_DUP_MIN_WORDS) -> np.ndarray | None:
+    """Hashes of the word k-shingles of text (case- and whitespace-insensitive).
+
+    None when the body has fewer than min_words words.
+    """
+    words = text.lower().split()
+    if len(words) < max(min_words, 1):
+        return None
+
+    h = np.fromiter((zlib.crc32(w.encode("utf-8")) for w in words), dtype=np.uint64, count=len(words))
+    k = min(k, len(words))
+    n = len(words) - k + 1
+
+    shingles = h[:n].copy()
+    with np.errstate(over="ignore"):
+        for j in range(1, k):
+            shingles = shingles * _SHINGLE_MULT + h[j:j + n]
+    return np.unique(shingles)
+
+
+def minhash_signature(shingles: np.ndarray, seeds: np.ndarray) -> np.ndarray:
+    with np.errstate(over="ignore"):
+        # the high 32 bits are plenty to compare minima and halve the memory
+        return (_splitmix64(shingles[:, None] ^ seeds).min(axis=0) >> np.uint64(32)).astype(np.uint32)
+
+
+def lsh_bands(threshold: float, num_perm: int) -> tuple[int, int]:
+    """(bands, rows) with bands * rows == num_perm for an LSH threshold.
+
+    Takes the split whose S-curve midpoint (1/bands)**(1/rows) is the
+    highest one not above threshold: candidates are verified afterwards,
+    so extra candidates only cost time while a high midpoint loses pairs.
+    """
+    splits = [(bands, num_perm // bands) for bands in range(1, num_perm + 1) if num_perm % bands == 0]
+    below = [br for br in splits if (1 / br[0]) ** (1 / br[1]) <= threshold]
+    return max(below or splits[-1:], key=lambda br: (1 / br[0]) ** (1 / br[1]))
+
+
+def near_duplicate_clusters(
+    signatures: np.ndarray,
+    threshold: float = NEAR_DUP_THRESHOLD,
+    order: np.ndarray | None = None,
+) -> tuple[np.ndarray, np.ndarray]:
+    """(representative row, estimated Jaccard to it) per signature row.
+
+    Greedy star clustering: rows are visited in order (earliest first) and
+    a row not yet taken becomes a representative. Rows sharing an LSH band
+    bucket with it join its cluster when their estimated Jaccard (share of
+    equal minhashes) to the representative itself is at least threshold,
+    so a chain of similar bodies does not merge into one cluster.
+    """
+    n, num_perm = signatures.shape
+    representative = np.arange(n)
+    similarity = np.ones(n, dtype=np.float32)
+    if n < 2:
+        return representative, similarity
+
+    bands, rows = lsh_bands(threshold, num_perm)
+
+    # per band: bucket of every row and the rows of each shared bucket
+    band_buckets = []
+    for band in range(bands):
+        _, bucket, counts = np.unique(
+            signatures[:, band * rows:(band + 1) * rows],
+            axis=0, return_inverse=True, return_counts=True,
         )
+        bucket = bucket.ravel()
+        members = np.argsort(bucket, kind="stable")
+        starts = np.concatenate(([0], np.cumsum(counts)))
+        band_buckets.append((bucket, counts, members, starts))
+
+    taken = np.zeros(n, dtype=bool)
+    for head in (np.arange(n) if order is None else order).tolist():
+        if taken[head]:
+            continue
+        taken[head] = True
 
-        print("Inserted:", len(rows))
-        offset += CHUNK_SIZE
+        candidates = [
+            members[starts[bucket[head]]:starts[bucket[head] + 1]]
+            for bucket, counts, members, starts in band_buckets
+            if counts[bucket[head]] > 1
+        ]
+        if not candidates:
+            continue
+        candidates = np.unique(np.concatenate(candidates))
+        candidates = candidates[~taken[candidates]]
+        if not len(candidates):
+            continue
+
+        sims = (signatures[candidates] == signatures[head]).mean(axis=1)
+        joined = candidates[sims >= threshold]
+        taken[joined] = True
+        representative[joined] = head
+        similarity[joined] = sims[sims >= threshold]
+
+    return representative, similarity
+
+
+def near_dedup_emails(
+    threshold: float = NEAR_DUP_THRESHOLD,
+    num_perm: int = NEAR_DUP_NUM_PERM,
+    fetch_batch: int = CHUNK_SIZE,
+) -> dict:
+    """Collapse near-duplicate bodies across threads in emails_unique.
+
+    Keeps the earliest email of every cluster, tombstones the others and
+    records them in mailkb.email_near_duplicates. Run after every dedup:
+    a recomputed thread brings its near-duplicates back.
+    """
+    client = get_clickhouse_client()
+    insert_stats = InsertStats()
+    seeds = minhash_seeds(num_perm)
+
+    ids, thread_keys, sent_at, chars, signatures = [], [], [], [], []
+    skipped = 0
+    last_id = ""
+
+    while True:
+        rows = client.query("""
+            SELECT id, thread_key, sent_at_utc, body_text
+            FROM mailkb.emails_unique FINAL
+            WHERE id > %(last_id)s
+            ORDER BY id
+            LIMIT %(limit)s
+        """, {"last_id": last_id, "limit": fetch_batch}).result_rows
+
+        if not rows:
+            break
+
+        for eid, thread_key, sent_at_utc, body in rows:
+            shingles = shingle_hashes(body or "")
+            if shingles is None:
+                skipped += 1
+                continue
+            ids.append(eid)
+            thread_keys.append(thread_key)
+            sent_at.append(sent_at_utc)
+            chars.append(len(body))
+            signatures.append(minhash_signature(shingles, seeds))
+
+        last_id = rows[-1][0]
+        print(f"[near-dedup] signed {len(ids)} bodies ({skipped} too short)")
+
+    report = {
+        "bodies": len(ids),
+        "too_short": skipped,
+        "clusters": 0,
+        "removed": 0,
+        "skipped_llm_emails": 0,
+        "saved_input_tokens": 0,
+        "saved_embeddings": 0,
+    }
+    if not ids:
+        print(f"[near-dedup] DONE: {report}")
+        return report
+
+    signatures = np.vstack(signatures)
+    # representative: the earliest email of the cluster
+    order = np.array(sorted(range(len(ids)), key=lambda i: (sent_at[i], ids[i])))
+    representative, similarity = near_duplicate_clusters(signatures, threshold, order)
+
+    clusters = {}
+    for i in order.tolist():
+        clusters.setdefault(representative[i], []).append(i)
+
+    tombstones = {c: [] for c in ["id", "thread_key", *TOMBSTONE_DEFAULTS]}
+    mapping = {c: [] for c in ["email_id", "representative_id", "similarity"]}
+
+    for members in clusters.values():
+        if len(members) < 2:
+            continue
+        report["clusters"] += 1
+        head = members[0]
+        for i in members[1:]:
+            tombstones["id"].append(ids[i])
+            tombstones["thread_key"].append(thread_keys[i])
+            for c, value in TOMBSTONE_DEFAULTS.items():
+                tombstones[c].append(value)
+            mapping["email_id"].append(ids[i])
+            mapping["representative_id"].append(ids[head])
+            mapping["similarity"].append(float(similarity[i]))
+            report["removed"] += 1
+            # a removed body is neither cleaned nor parsed; ~4 chars per token
+            report["saved_input_tokens"] += 2 * chars[i] // 4
+
+    # clean and parse pack several emails per request, so count emails, not calls
+    report["skipped_llm_emails"] = report["removed"]
+    report["saved_embeddings"] = report["removed"]
+
+    if report["removed"]:
+        tombstones["version"] = [time.time_ns()] * report["removed"]
+        tombstones["is_deleted"] = [1] * report["removed"]
+        bulk_insert(client, "mailkb.email_near_duplicates", list(mapping.values()), list(mapping),
+                    columnar=True, stats=insert_stats)
+        bulk_insert(client, "mailkb.emails_unique", list(tombstones.values()), list(tombstones),
+                    columnar=True, async_insert=CH_ASYNC_INSERT, stats=insert_stats)
+
+    print(
+        f"[near-dedup] DONE: bodies={report['bodies']}, clusters={report['clusters']}, "
+        f"removed={report['removed']}, emails skipped by the LLM={report['skipped_llm_emails']} "
+        f"(~{report['saved_input_tokens']} input tokens), saved embeddings={report['saved_embeddings']}"
+    )
+    print(insert_stats.summary())
+    return report
 
 
 # =========================================================
@@ -470,9 +2224,63 @@ clean_single_agent = build_structured_agent(CleanBody)
 clean_batch_agent = build_structured_agent(CleanBatch)
 
 
-def body_md5(text):
-    text = (text or "").strip()
-    return hashlib.md5(text.encode("utf-8")).hexdigest()
+# Rule-based pre-cleaning (from clean_text/RE_QUOTED/RE_HDR of the old
+# indexer): everything from the first reply separator on is quoted history.
+RE_QUOTED = re.compile(r"(?m)^[ \t]*>.*(?:\n|$)")
+RE_REPLY_SEPARATOR = re.compile(
+    r"(?im)^[ \t]*(?:"
+    r"-{2,}[ \t]*(?:original message|forwarded message|исходное сообщение|пересылаемое сообщение)[ \t]*-{2,}"
+    # an underscore rule only when an Outlook header block follows it
+    r"|_{10,}[ \t]*\n[ \t]*(?:from|от)[ \t]*:"
+    r"|on .{1,200}wrote:[ \t]*$"
+    r"|.{1,200}(?:написал|написала|пишет)\(?а?\)?:[ \t]*$"
+    # Outlook header block: From:/От: followed within 3 lines by Sent:/Date:/Отправлено:/Дата:
+    # with a date value (a year or a time)
+    r"|(?:from|от)[ \t]*:.*\n(?:.*\n){0,2}?[ \t]*(?:sent|date|отправлено|дата)[ \t]*:.*?(?:\d{4}|\d{1,2}:\d{2})"
+    r")"
+)
+RE_HDR_LINE = re.compile(r"(?im)^[ \t]*(?:from|sent|to|cc|subject|от|отправлено|кому|копия|тема)[ \t]*:")
+RE_SIGNOFF = re.compile(
+    r"(?im)^[ \t]*(?:--[ \t]*|best regards,?|kind regards,?|regards,?|cheers,?|с уважением,?|с наилучшими пожеланиями,?)[ \t]*$"
+)
+RE_FOOTER = re.compile(r"(?i)confidential|disclaimer|конфиденциальн|unsubscribe|tel[.:]|тел[.:]|mob[.:]|моб[.:]|www\.|https?://")
+SIGNOFF_MAX_TAIL_LINES = 8
+
+
+def pre_clean_body(text: str) -> tuple[str, bool]:
+    """Cut quoted history and a trailing sign-off; return (residual, clean).
+
+    clean means nothing in the residual still needs the LLM: no header
+    lines, no footer markers and at most PRECLEAN_MAX_CHARS characters.
+    When the cut leaves nothing (a bare forward or quote), the original
+    body is returned for the LLM instead.
+    """
+    t = (text or "").replace("\r\n", "\n").replace("\r", "\n")
+
+    separator = RE_REPLY_SEPARATOR.search(t)
+    if separator:
+        t = t[:separator.start()]
+    t = RE_QUOTED.sub("", t)
+
+    lines = [ln.rstrip() for ln in t.split("\n")]
+    while lines and not lines[-1].strip():
+        lines.pop()
+
+    # a sign-off near the end starts the signature; keep it when nothing precedes it
+    for i in range(max(0, len(lines) - SIGNOFF_MAX_TAIL_LINES), len(lines)):
+        if RE_SIGNOFF.match(lines[i]) and any(ln.strip() for ln in lines[:i]):
+            lines = lines[:i]
+            break
+
+    residual = re.sub(r"\n{3,}", "\n\n", "\n".join(lines)).strip()
+    if not residual:
+        return (text or "").strip(), False
+    clean = (
+        len(residual) <= PRECLEAN_MAX_CHARS
+        and not RE_HDR_LINE.search(residual)
+        and not RE_FOOTER.search(residual)
+    )
+    return residual, clean
 
 
 def clean_email_body(text: str):
@@ -504,108 +2312,256 @@ def clean_email_bodies_batch(md5_and_text: List[tuple[str, str]]) -> dict[str, s
     return out
 
 
-def clean_email_bodies_from_db(fetch_batch: int = 30, llm_batch: int = 5):
-    client = get_clickhouse_client()
+CLEAN_CACHE_COLUMNS = [
+    "raw_md5",
+    "parser_version",
+    "model_name",
+    "status",
+    "body_clean",
+    "error",
+    "tokens_in",
+    "tokens_out",
+    "latency_ms",
+]
+
+
+def format_preclean_report(report: dict) -> str:
+    saved_chars = report["raw_chars"] - report["llm_chars"]
+    return (
+        f"[clean] bodies={report['bodies']}, by rules={report['rules']}, "
+        f"to LLM={report['llm']} in {report['requests']} requests, "
+        f"chars raw={report['raw_chars']} sent={report['llm_chars']}, "
+        f"saved ~{saved_chars // 4} input tokens ({saved_chars / max(report['raw_chars'], 1):.0%})"
+    )
 
-    print("Loading cache...")
-    cached_md5 = set(r[0] for r in client.query("""
-        SELECT raw_md5 FROM mailkb.llm_body_clean_cache
-    """).result_rows)
-    print("Cached:", len(cached_md5))
 
-    last_id = "00000000-0000-0000-0000-000000000000"
+@lru_cache(maxsize=1)
+def _token_encoding():
+    try:
+        import tiktoken
 
-    while True:
-        rows = client.query("""
-            SELECT id, body_text
-            FROM mailkb.emails_unique
-            WHERE body_text IS NOT NULL AND body_text != ''
-              AND id > %(last_id)s
-            ORDER BY id
-            LIMIT %(limit)s
-        """, {"last_id": last_id, "limit": fetch_batch}).result_rows
+        return tiktoken.get_encoding(LLM_TOKEN_ENCODING)
+    except Exception:  # not installed, or the encoding file cannot be fetched
+        return None
 
-        if not rows:
-            print("No rows found, stop.")
-            break
 
-        to_process = []
-        batch_meta = []
+def count_tokens(text: str) -> int:
+    """Token count with tiktoken when available, else ~4 UTF-8 bytes per token.
 
-        for email_id, body in rows:
-            md5 = body_md5(body)
-            if md5 in cached_md5:
-                continue
+    Bytes rather than characters: Cyrillic takes about twice the tokens per
+    character of Latin text.
+    """
+    encoding = _token_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    return len(text.encode("utf-8")) // 4 + 1
+
+
+def pack_by_tokens(
+    items: list,
+    costs: list[tuple[int, int]],
+    max_items: int = 0,
+    base_tokens: int = 0,
+    prompt_budget: int = LLM_PROMPT_TOKEN_BUDGET,
+    output_budget: int = LLM_OUTPUT_TOKEN_BUDGET,
+) -> list[tuple[list, int, int]]:
+    """Group items, in order, into (batch, prompt_tokens, output_tokens) requests.
+
+    costs holds each item's estimated (prompt, output) tokens; base_tokens
+    is the prompt overhead of a request. A batch closes before it would
+    exceed either budget or max_items (0 = no cap); an item over budget
+    on its own is sent alone.
+    """
+    batches = []
+    batch, prompt_tokens, output_tokens = [], base_tokens, 0
+
+    for item, (item_prompt, item_output) in zip(items, costs):
+        if batch and (
+            (max_items and len(batch) >= max_items)
+            or prompt_tokens + item_prompt > prompt_budget
+            or output_tokens + item_output > output_budget
+        ):
+            batches.append((batch, prompt_tokens, output_tokens))
+            batch, prompt_tokens, output_tokens = [], base_tokens, 0
+        batch.append(item)
+        prompt_tokens += item_prompt
+        output_tokens += item_output
+
+    if batch:
+        batches.append((batch, prompt_tokens, output_tokens))
+    return batches
+
+
+# per-body framing ("raw_md5: ...", separators) and JSON item overhead
+CLEAN_ITEM_PROMPT_TOKENS = 30
+CLEAN_ITEM_OUTPUT_TOKENS = 30
+
+
+def clean_chunk(
+    chunk_meta: list[tuple[str, str, str]],
+    limiter: RateLimiter | None = None,
+    tokens: int = 0,
+) -> list[list]:
+    """LLM-clean one chunk of (email_id, md5, text); return its cache rows (success or failed).
+
+    tokens is the chunk's estimated prompt + output size for the limiter.
+    """
+    chunk = [(md5, text) for _, md5, text in chunk_meta]
 
-            to_process.append((md5, body))
-            batch_meta.append((email_id, md5, body))
+    if limiter is not None:
+        limiter.acquire(tokens)
 
-        if not to_process:
-            last_id = rows[-1][0]
-            continue
+    start = time.time()
+    rows = []
 
-        last_id = rows[-1][0]
+    try:
+        cleaned_map = clean_email_bodies_batch(chunk)
+        latency_ms = int((time.time() - start) * 1000)
 
-        for i in range(0, len(to_process), llm_batch):
-            chunk = to_process[i:i + llm_batch]
-            chunk_meta = batch_meta[i:i + llm_batch]
+        for email_id, md5, text in chunk_meta:
+            rows.append([md5, "v1", LLM_MODEL, "success", cleaned_map.get(md5, ""), "", 0, 0, latency_ms])
 
-            start = time.time()
-            insert_batch = []
+    except Exception as e:
+        for email_id, md5, text in chunk_meta:
+            rows.append([md5, "v1", LLM_MODEL, "failed", "", str(e), 0, 0, 0])
+
+    # one print per chunk: lines from concurrent chunks do not interleave
+    print(f"Processing: {', '.join(email_id for email_id, _, _ in chunk_meta)}")
+    return rows
+
+
+# Bodies of emails_unique without a llm_body_clean_cache row, one email
+# key per body. body_md5 is a MATERIALIZED column (MD5 of the trimmed
+# body, see sql/15), so the cache is matched in ClickHouse, not in a
+# Python set. Run once per clean: the join scans emails_unique and the
+# whole cache.
+PENDING_BODIES_SQL = """
+    SELECT e.body_md5, min((e.thread_key, e.id))
+    FROM mailkb.emails_unique AS e FINAL
+    LEFT ANTI JOIN (SELECT raw_md5 FROM mailkb.llm_body_clean_cache) AS c
+        ON e.body_md5 = c.raw_md5
+    WHERE e.body_text != ''
+    GROUP BY e.body_md5
+    ORDER BY e.body_md5
+"""
 
-            try:
-                cleaned_map = clean_email_bodies_batch(chunk)
-                latency_ms = int((time.time() - start) * 1000)
-
-                for email_id, md5, body in chunk_meta:
-                    cleaned = cleaned_map.get(md5, "")
-
-                    insert_batch.append([
-                        md5,
-                        "v1",
-                        LLM_MODEL,
-                        "success",
-                        cleaned,
-                        "",
-                        0,
-                        0,
-                        latency_ms
-                    ])
-                    cached_md5.add(md5)
-                    print("Processing:", email_id)
-
-            except Exception as e:
-                for email_id, md5, body in chunk_meta:
-                    insert_batch.append([
-                        md5,
-                        "v1",
-                        LLM_MODEL,
-                        "failed",
-                        "",
-                        str(e),
-                        0,
-                        0,
-                        0
-                    ])
-                    print("Processing:", email_id)
-
-            if insert_batch:
-                client.insert(
-                    "mailkb.llm_body_clean_cache",
-                    insert_batch,
-                    column_names=[
-                        "raw_md5",
-                        "parser_version",
-                        "model_name",
-                        "status",
-                        "body_clean",
-                        "error",
-                        "tokens_in",
-                        "tokens_out",
-                        "latency_ms"
-                    ]
-                )
-                print("Inserted:", len(insert_batch))
+
+def clean_email_bodies_from_db(
+    fetch_batch: int = 30,
+    llm_batch: int = 5,
+    preclean: bool = PRECLEAN,
+    max_in_flight: int = CLEAN_MAX_IN_FLIGHT,
+):
+    """Clean new emails_unique bodies into llm_body_clean_cache; return the pre-clean report.
+
+    With preclean, quoted history is cut by pre_clean_body before the LLM
+    sees a body, and clean residuals are stored with model_name "rules".
+    The uncached bodies are listed once (PENDING_BODIES_SQL) and their
+    texts fetched by primary key, fetch_batch distinct bodies per page. They are packed into requests of at most
+    llm_batch bodies within the LLM token budgets (pack_by_tokens); up to
+    max_in_flight requests run concurrently under LLM_REQUESTS_PER_MIN /
+    LLM_TOKENS_PER_MIN. Fetching pauses while 2 * max_in_flight chunks are
+    queued, and cache rows are inserted CLEAN_INSERT_BATCH at a time.
+    """
+    client = get_clickhouse_client()
+    insert_stats = InsertStats()
+    report = {"bodies": 0, "rules": 0, "llm": 0, "requests": 0, "raw_chars": 0, "llm_chars": 0}
+    limiter = RateLimiter(LLM_REQUESTS_PER_MIN, LLM_TOKENS_PER_MIN)
+    max_in_flight = max(1, max_in_flight)
+    clean_prompt_tokens = count_tokens(CLEAN_BATCH_PROMPT)
+
+    pending_keys = client.query(PENDING_BODIES_SQL).result_rows
+    print("Pending bodies:", len(pending_keys))
+
+    cache_rows = []
+
+    def flush(force=False):
+        if cache_rows and (force or len(cache_rows) >= CLEAN_INSERT_BATCH):
+            bulk_insert(
+                client,
+                "mailkb.llm_body_clean_cache",
+                cache_rows,
+                CLEAN_CACHE_COLUMNS,
+                async_insert=CH_ASYNC_INSERT,
+                stats=insert_stats,
+            )
+            print("Inserted:", len(cache_rows))
+            cache_rows.clear()
+
+    def collect(done):
+        for future in done:
+            cache_rows.extend(future.result())
+        flush()
+
+    offset = 0
+    pending = set()
+
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        while True:
+            # backpressure: do not read further ahead than the LLM can take
+            while len(pending) >= 2 * max_in_flight:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+
+            page = pending_keys[offset:offset + fetch_batch]
+            if not page:
+                print("No rows found, stop.")
+                break
+            offset += len(page)
+
+            # thread_key leads the emails_unique sort key, so this reads only
+            # the granules of the page's threads
+            bodies = dict(client.query("""
+                SELECT id, body_text
+                FROM mailkb.emails_unique FINAL
+                WHERE thread_key IN %(threads)s
+                  AND id IN %(ids)s
+            """, {
+                "threads": tuple({thread_key for _, (thread_key, _) in page}),
+                "ids": tuple(email_id for _, (_, email_id) in page),
+            }).result_rows)
+
+            batch_meta = []
+
+            for md5, (_, email_id) in page:
+                body = bodies.get(email_id)
+                if not body:
+                    # replaced or deleted since the pending list was read
+                    continue
+                report["bodies"] += 1
+                report["raw_chars"] += len(body)
+                text, clean = pre_clean_body(body) if preclean else (body, False)
+
+                if clean:
+                    cache_rows.append([md5, "v1", "rules", "success", text, "", 0, 0, 0])
+                    report["rules"] += 1
+                    continue
+
+                report["llm"] += 1
+                report["llm_chars"] += len(text)
+                batch_meta.append((email_id, md5, text))
+
+            # the cleaned text is at most the body, so it is its output estimate
+            costs = []
+            for _, _, text in batch_meta:
+                tokens = count_tokens(text)
+                costs.append((tokens + CLEAN_ITEM_PROMPT_TOKENS, tokens + CLEAN_ITEM_OUTPUT_TOKENS))
+
+            for chunk, prompt_tokens, output_tokens in pack_by_tokens(
+                batch_meta, costs, llm_batch, clean_prompt_tokens,
+            ):
+                report["requests"] += 1
+                pending.add(executor.submit(clean_chunk, chunk, limiter, prompt_tokens + output_tokens))
+            flush()
+
+        collect(pending)
+
+    flush(force=True)
+    print(format_preclean_report(report))
+    if limiter.waited:
+        print(f"[clean] rate limiter waited {limiter.waited:.1f}s")
+    print(insert_stats.summary())
+    return report
 
 
 # =========================================================
@@ -671,16 +2627,32 @@ parse_agent = build_structured_agent(ParsedEmailBatch)
 structured_llm = _get_llm().with_structured_output(ParsedEmailBatch, method="json_mode")
 
 
-def chunk_list(rows, batch_size):
-    for i in range(0, len(rows), batch_size):
-        yield rows[i:i + batch_size]
+PARSE_BODY_MAX_CHARS = 15000
+# per-email framing in the prompt, and JSON/thread-entry overhead in the answer
+PARSE_ITEM_PROMPT_TOKENS = 30
+PARSE_ITEM_OUTPUT_TOKENS = 150
+
+
+def pack_parse_batches(rows, batch_size: int) -> list[list]:
+    """Pack rows into parse requests of at most batch_size emails within the token budgets.
+
+    The parsed thread repeats the bodies, so each body counts toward both
+    the prompt and the output budget.
+    """
+    costs = []
+    for row in rows:
+        tokens = count_tokens((row["body_text"] or "")[:PARSE_BODY_MAX_CHARS])
+        costs.append((tokens + PARSE_ITEM_PROMPT_TOKENS, tokens + PARSE_ITEM_OUTPUT_TOKENS))
+
+    base_tokens = count_tokens(build_parse_batch_prompt([]))
+    return [batch for batch, _, _ in pack_by_tokens(rows, costs, batch_size, base_tokens)]
 
 
 def build_parse_batch_prompt(batch_rows):
     parts = []
 
     for idx, row in enumerate(batch_rows, start=1):
-        body = (row["body_text"] or "")[:15000]
+        body = (row["body_text"] or "")[:PARSE_BODY_MAX_CHARS]
 
         parts.append(
             f"""
@@ -759,7 +2731,7 @@ def parse_emails_from_db(limit: int = 50, batch_size: int = 3, max_workers: int
         id,
         sent_at_utc,
         body_text
-    FROM mailkb.emails_unique
+    FROM mailkb.emails_unique FINAL
 
     LEFT ANTI JOIN mailkb.mail_parsed
     ON emails_unique.id = mail_parsed.email_id
@@ -774,7 +2746,8 @@ def parse_emails_from_db(limit: int = 50, batch_size: int = 3, max_workers: int
 
     df = client.query_df(query)
     rows = df.to_dict("records")
-    batches = list(chunk_list(rows, batch_size))
+    batches = pack_parse_batches(rows, batch_size)
+    print(f"parse: {len(rows)} emails in {len(batches)} requests")
 
     all_success = []
     all_errors = []
@@ -791,11 +2764,16 @@ def parse_emails_from_db(limit: int = 50, batch_size: int = 3, max_workers: int
     print("errors:", len(all_errors))
 
     if all_success:
-        insert_rows = [[r["email_id"], r["parsed_json"]] for r in all_success]
-        client.insert(
+        bulk_insert(
+            client,
             "mailkb.mail_parsed",
-            insert_rows,
-            column_names=["email_id", "parsed_json"]
+            [
+                [r["email_id"] for r in all_success],
+                [r["parsed_json"] for r in all_success],
+            ],
+            ["email_id", "parsed_json"],
+            columnar=True,
+            async_insert=CH_ASYNC_INSERT,
         )
 
     return {
@@ -870,7 +2848,7 @@ def load_join_batch(limit: int, offset: int) -> pd.DataFrame:
         e.sent_at_utc,
         e.folder,
         p.parsed_json
-    FROM mailkb.emails_unique e
+    FROM mailkb.emails_unique AS e FINAL
     INNER JOIN mailkb.mail_parsed p
         ON e.id = p.email_id
     ORDER BY e.sent_at_utc ASC, e.id ASC
@@ -895,7 +2873,7 @@ def load_all_joined_df() -> pd.DataFrame:
         e.sent_at_utc,
         e.folder,
         p.parsed_json
-    FROM mailkb.emails_unique e
+    FROM mailkb.emails_unique AS e FINAL
     INNER JOIN mailkb.mail_parsed p
         ON e.id = p.email_id
     ORDER BY e.sent_at_utc ASC, e.id ASC
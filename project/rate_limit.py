@@ -0,0 +1,51 @@
+"""Token-bucket limits for LLM calls (requests/min and tokens/min)."""
+import threading
+import time
+
+
+class TokenBucket:
+    """capacity units refilled evenly over a minute; capacity <= 0 means unlimited."""
+
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.level = self.capacity
+        self.rate = self.capacity / 60.0
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """Seconds until amount is available (0 = now). Amounts above capacity wait for a full bucket."""
+        if self.capacity <= 0:
+            return 0.0
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        return max(0.0, (amount - self.level) / self.rate)
+
+    def take(self, amount: float):
+        if self.capacity > 0:
+            self.level -= min(amount, self.capacity)
+
+
+class RateLimiter:
+    """Blocks callers until both the request and the token bucket allow a call."""
+
+    def __init__(self, requests_per_min: float = 0, tokens_per_min: float = 0):
+        self.lock = threading.Lock()
+        self.requests = TokenBucket(requests_per_min)
+        self.tokens = TokenBucket(tokens_per_min)
+        self.waited = 0.0
+
+    def acquire(self, tokens: int = 0):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                delay = max(self.requests.wait_time(1, now), self.tokens.wait_time(tokens, now))
+                if delay <= 0:
+                    self.requests.take(1)
+                    self.tokens.take(tokens)
+                    return
+                self.waited += delay
+            time.sleep(delay)
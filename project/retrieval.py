@@ -107,7 +107,7 @@ def get_project_corpus_batch(
         e.sent_at_utc,
         e.folder,
         p.parsed_json
-    FROM mailkb.emails_unique e
+    FROM mailkb.emails_unique AS e FINAL
     INNER JOIN mailkb.mail_parsed p
         ON e.id = p.email_id
     WHERE e.id IN ({quoted_ids})
@@ -14,5 +14,5 @@ CREATE TABLE mailkb.emails
     body_text String,
     body_html String
 )
-ENGINE = MergeTree
+ENGINE = ReplacingMergeTree
 ORDER BY id;
\ No newline at end of file
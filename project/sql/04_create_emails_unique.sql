@@ -10,7 +10,9 @@ CREATE TABLE IF NOT EXISTS mailkb.emails_unique
     bcc_addr Array(String),
     sent_at_utc DateTime,
     folder String,
-    body_text String
+    body_text String,
+    version UInt64,
+    is_deleted UInt8 DEFAULT 0
 )
-ENGINE = MergeTree
-ORDER BY (thread_key, sent_at_utc);
+ENGINE = ReplacingMergeTree(version, is_deleted)
+ORDER BY (thread_key, id);
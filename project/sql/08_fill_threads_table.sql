@@ -26,7 +26,7 @@ FROM
         toUInt32(count()) AS unique_emails_count,
         min(sent_at_utc) AS first_sent_at,
         max(sent_at_utc) AS last_sent_at
-    FROM mailkb.emails_unique
+    FROM mailkb.emails_unique FINAL
     WHERE thread_key != ''
     GROUP BY thread_key
 );
\ No newline at end of file
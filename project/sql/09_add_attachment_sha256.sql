@@ -0,0 +1,2 @@
+ALTER TABLE mailkb.attachments
+ADD COLUMN IF NOT EXISTS sha256 String
\ No newline at end of file
@@ -0,0 +1,2 @@
+ALTER TABLE mailkb.emails
+ADD COLUMN IF NOT EXISTS ingested_at DateTime DEFAULT now()
\ No newline at end of file
@@ -0,0 +1,2 @@
+ALTER TABLE mailkb.emails
+MATERIALIZE COLUMN ingested_at
\ No newline at end of file
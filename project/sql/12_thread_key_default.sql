@@ -0,0 +1,9 @@
+ALTER TABLE mailkb.emails
+MODIFY COLUMN thread_key String DEFAULT
+lower(
+    replaceRegexpAll(
+        subject,
+        '^(?i)((re|fw|fwd|ответ|aw)\\s*:\\s*)+',
+        ''
+    )
+)
\ No newline at end of file
@@ -0,0 +1,10 @@
+CREATE TABLE IF NOT EXISTS mailkb.dedup_runs
+(
+    finished_at DateTime DEFAULT now(),
+    watermark DateTime,
+    mode String,
+    chunks UInt32,
+    rows UInt64
+)
+ENGINE = MergeTree
+ORDER BY finished_at
\ No newline at end of file
@@ -0,0 +1,9 @@
+CREATE TABLE IF NOT EXISTS mailkb.email_near_duplicates
+(
+    email_id String,
+    representative_id String,
+    similarity Float32,
+    created_at DateTime DEFAULT now()
+)
+ENGINE = ReplacingMergeTree(created_at)
+ORDER BY email_id
\ No newline at end of file
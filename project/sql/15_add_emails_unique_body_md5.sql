@@ -0,0 +1,3 @@
+ALTER TABLE mailkb.emails_unique
+ADD COLUMN IF NOT EXISTS body_md5 String
+MATERIALIZED lower(hex(MD5(trim(BOTH ' \t\n\r\x0B\x0C' FROM body_text))))
\ No newline at end of file
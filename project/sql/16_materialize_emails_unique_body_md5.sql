@@ -0,0 +1,2 @@
+ALTER TABLE mailkb.emails_unique
+MATERIALIZE COLUMN body_md5
\ No newline at end of file
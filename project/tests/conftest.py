@@ -121,14 +121,27 @@ def client():
 def mock_pipeline(monkeypatch):
     calls = {}
 
-    def mock_import():
+    def mock_import(max_emails=0, workers=1, resume=True, header_filter=None):
         calls["import_mbox"] = True
+        calls["import_args"] = {"max_emails": max_emails, "workers": workers, "resume": resume}
+        calls["import_filter"] = header_filter
 
-    def mock_dedup():
+    def mock_import_pst(max_emails=0, workers=1, resume=True):
+        calls["import_pst"] = {"max_emails": max_emails, "workers": workers, "resume": resume}
+
+    def mock_dedup(workers=1, full=False, processes=1):
         calls["dedup"] = True
+        calls["dedup_workers"] = workers
+        calls["dedup_full"] = full
+        calls["dedup_processes"] = processes
+
+    def mock_near_dedup(threshold=0.85, num_perm=64):
+        calls["near_dedup"] = {"threshold": threshold, "num_perm": num_perm}
+        return {"removed": 3, "skipped_llm_emails": 3}
 
-    def mock_clean(fetch_batch=30, llm_batch=5):
+    def mock_clean(fetch_batch=30, llm_batch=5, max_in_flight=4):
         calls["clean"] = {"fetch_batch": fetch_batch, "llm_batch": llm_batch}
+        calls["clean_max_in_flight"] = max_in_flight
 
     def mock_parse(limit=50, batch_size=3, max_workers=6):
         calls["parse"] = {"limit": limit, "batch_size": batch_size, "max_workers": max_workers}
@@ -138,7 +151,9 @@ def mock_pipeline(monkeypatch):
         calls["index"] = {"batch_size": batch_size, "recreate": recreate}
 
     monkeypatch.setattr("app.import_mbox_to_clickhouse", mock_import)
+    monkeypatch.setattr("app.import_pst_to_clickhouse", mock_import_pst)
     monkeypatch.setattr("app.deduplicate_emails", mock_dedup)
+    monkeypatch.setattr("app.near_dedup_emails", mock_near_dedup)
     monkeypatch.setattr("app.clean_email_bodies_from_db", mock_clean)
     monkeypatch.setattr("app.parse_emails_from_db", mock_parse)
     monkeypatch.setattr("app.index_messages", mock_index)
@@ -1,3 +1,6 @@
+import pytest
+
+
 def test_health(client):
     resp = client.get("/health")
     assert resp.status_code == 200
@@ -57,18 +60,63 @@ class TestPipeline:
         assert resp.json() == {"status": "ok"}
         assert mock_pipeline["import_mbox"] is True
 
+    def test_import_mbox_workers(self, client, mock_pipeline):
+        resp = client.post("/pipeline/import-mbox", json={"max_emails": 100, "workers": 8})
+        assert resp.status_code == 200
+        assert mock_pipeline["import_args"] == {"max_emails": 100, "workers": 8, "resume": True}
+
+    def test_import_mbox_no_resume(self, client, mock_pipeline):
+        resp = client.post("/pipeline/import-mbox", json={"resume": False})
+        assert resp.status_code == 200
+        assert mock_pipeline["import_args"]["resume"] is False
+
+    def test_import_mbox_header_filter(self, client, mock_pipeline):
+        resp = client.post(
+            "/pipeline/import-mbox",
+            json={"header_filter": {"date_from": "2024-01-01T00:00:00", "folders": ["Inbox/*"]}},
+        )
+        assert resp.status_code == 200
+        f = mock_pipeline["import_filter"]
+        assert f.folders == ["Inbox/*"]
+        assert f.date_from.year == 2024
+        assert f.sender_domains == []
+
     def test_import_mbox_twice(self, client, mock_pipeline):
         client.post("/pipeline/import-mbox")
         resp = client.post("/pipeline/import-mbox")
         assert resp.status_code == 200
         assert resp.json() == {"status": "ok"}
 
+    def test_import_pst(self, client, mock_pipeline):
+        resp = client.post("/pipeline/import-pst", json={"workers": 4, "resume": False})
+        assert resp.status_code == 200
+        assert resp.json() == {"status": "ok"}
+        assert mock_pipeline["import_pst"] == {"max_emails": 0, "workers": 4, "resume": False}
+
     def test_dedup(self, client, mock_pipeline):
         resp = client.post("/pipeline/dedup")
         assert resp.status_code == 200
         assert resp.json() == {"status": "ok"}
         assert mock_pipeline["dedup"] is True
 
+    def test_dedup_workers(self, client, mock_pipeline):
+        resp = client.post("/pipeline/dedup", json={"workers": 4, "processes": 8})
+        assert resp.status_code == 200
+        assert mock_pipeline["dedup_workers"] == 4
+        assert mock_pipeline["dedup_processes"] == 8
+        assert mock_pipeline["dedup_full"] is False
+
+    def test_dedup_full(self, client, mock_pipeline):
+        resp = client.post("/pipeline/dedup", json={"full": True})
+        assert resp.status_code == 200
+        assert mock_pipeline["dedup_full"] is True
+
+    def test_near_dedup(self, client, mock_pipeline):
+        resp = client.post("/pipeline/near-dedup", json={"threshold": 0.9})
+        assert resp.status_code == 200
+        assert resp.json()["report"]["skipped_llm_emails"] == 3
+        assert mock_pipeline["near_dedup"]["threshold"] == 0.9
+
     def test_clean_bodies_defaults(self, client, mock_pipeline):
         resp = client.post("/pipeline/clean-bodies", json={})
         assert resp.status_code == 200
@@ -80,6 +128,11 @@ class TestPipeline:
         assert resp.status_code == 200
         assert mock_pipeline["clean"] == {"fetch_batch": 10, "llm_batch": 2}
 
+    def test_clean_bodies_max_in_flight(self, client, mock_pipeline):
+        resp = client.post("/pipeline/clean-bodies", json={"max_in_flight": 8})
+        assert resp.status_code == 200
+        assert mock_pipeline["clean_max_in_flight"] == 8
+
     def test_clean_bodies_zero_values(self, client, mock_pipeline):
         resp = client.post("/pipeline/clean-bodies", json={"fetch_batch": 0, "llm_batch": 0})
         assert resp.status_code == 200
@@ -284,3 +337,159 @@ class TestInitEdgeCases:
         assert resp.status_code == 200
         data = resp.json()
         assert any(r["status"].startswith("error") for r in data["results"])
+
+
+class TestImportErrors:
+    def test_import_fails_when_clickhouse_client_fails(self, tmp_path, monkeypatch):
+        import multiprocessing
+
+        import pipeline
+
+        mbox = tmp_path / "inbox.mbox"
+        mbox.write_bytes(b"".join(
+            b"From a@example.com Mon Jan  1 00:00:00 2024\n"
+            b"From: a@example.com\nSubject: status %d\nDate: Mon, 1 Jan 2024 00:00:00 +0000\n\n"
+            b"body %d\n\n" % (i, i)
+            for i in range(50)
+        ))
+
+        def broken_client():
+            raise ConnectionError("clickhouse down")
+
+        monkeypatch.setattr(pipeline, "create_clickhouse_client", broken_client)
+        monkeypatch.setattr(pipeline, "MBOX_DIR", str(tmp_path))
+        monkeypatch.setattr(pipeline, "BATCH", 1)
+        monkeypatch.setattr(pipeline, "IMPORT_QUEUE_SIZE", 1)
+        monkeypatch.setattr(pipeline, "SAVE_ATTACHMENTS", False)
+        pipeline._init_import_worker(multiprocessing.Value("q", 0))
+
+        with pytest.raises(ConnectionError):
+            pipeline.import_mbox_part(
+                mbox, 0, 0, mbox.stat().st_size,
+                show_progress=False, state_db=str(tmp_path / "state.db"),
+            )
+
+
+class TestPreClean:
+    def test_reply_with_quote(self):
+        from pipeline import pre_clean_body
+
+        body = "Sounds good, see you then.\n\nOn Mon, Jan 1, 2024 at 10:00 AM Bob <bob@example.com> wrote:\n> Can we meet?\n"
+        assert pre_clean_body(body) == ("Sounds good, see you then.", True)
+
+    def test_quoted_lines(self):
+        from pipeline import pre_clean_body
+
+        assert pre_clean_body("> Can we meet?\nYes, at 10.") == ("Yes, at 10.", True)
+
+    def test_pure_forward_goes_to_llm(self):
+        from pipeline import pre_clean_body
+
+        body = (
+            "---------- Forwarded message ----------\n"
+            "From: Bob <bob@example.com>\nDate: Mon, 1 Jan 2024 10:00\nSubject: Budget\n\nPlease review the budget."
+        )
+        assert pre_clean_body(body) == (body, False)
+
+    def test_pure_original_message_goes_to_llm(self):
+        from pipeline import pre_clean_body
+
+        body = "-----Original Message-----\nFrom: Bob\nSent: Monday, January 1, 2024 10:00 AM\n\nPlease review."
+        assert pre_clean_body(body) == (body, False)
+
+    def test_signoff_only(self):
+        from pipeline import pre_clean_body
+
+        assert pre_clean_body("Thanks, will do.\n\nBest regards,\nBob\n") == ("Thanks, will do.", True)
+        assert pre_clean_body("Best regards,\nBob") == ("Best regards,\nBob", True)
+
+    def test_outlook_header_block(self):
+        from pipeline import pre_clean_body
+
+        body = (
+            "Approved.\n\n________________________________\n"
+            "From: Ivan Petrov\nSent: Monday, January 1, 2024 10:00 AM\nTo: Bob\nSubject: Budget\n\nOld text"
+        )
+        assert pre_clean_body(body) == ("Approved.", True)
+
+    def test_ru_outlook_header_block(self):
+        from pipeline import pre_clean_body
+
+        body = (
+            "Согласовано.\n\nОт: Иван Петров\nОтправлено: 1 января 2024 г. 10:00\n"
+            "Кому: Борис\nТема: Бюджет\n\nстарый текст"
+        )
+        assert pre_clean_body(body) == ("Согласовано.", True)
+
+    def test_ru_wrote_and_forward(self):
+        from pipeline import pre_clean_body
+
+        body = "Да, подтверждаю.\n\n1 янв. 2024 г., в 10:00, Иван написал(а):\n> текст"
+        assert pre_clean_body(body) == ("Да, подтверждаю.", True)
+
+        forward = "-------- Пересылаемое сообщение --------\nОт: Иван\nДата: 01.01.2024\n\nтекст"
+        assert pre_clean_body(forward) == (forward, False)
+
+    def test_prose_with_from_is_not_cut(self):
+        from pipeline import pre_clean_body
+
+        body = "From: now on we meet on Fridays.\nsent: to everyone in the team"
+        residual, clean = pre_clean_body(body)
+        assert residual == body
+        assert clean is False
+
+    def test_underscore_rule_is_not_a_separator(self):
+        from pipeline import pre_clean_body
+
+        body = "Order details\n______________________\nItem 1: 5 pcs"
+        assert pre_clean_body(body) == (body, True)
+
+
+class TestNearDuplicateClusters:
+    def test_chain_does_not_merge(self):
+        import numpy as np
+
+        from pipeline import near_duplicate_clusters
+
+        rng = np.random.default_rng(0)
+        a = rng.integers(0, 2**32, 64, dtype=np.uint32)
+        b = a.copy()
+        b[48:56] += 1  # sim(A, B) = 0.875
+        c = b.copy()
+        c[56:64] += 1  # sim(B, C) = 0.875, sim(A, C) = 0.75
+        other = rng.integers(0, 2**32, 64, dtype=np.uint32)
+
+        representative, similarity = near_duplicate_clusters(
+            np.vstack([a, b, c, other]), threshold=0.85, order=np.array([0, 1, 2, 3]),
+        )
+        assert representative.tolist() == [0, 0, 2, 3]
+        assert similarity[1] == 0.875
+
+
+class TestPstExtractDedup:
+    def test_duplicate_inside_one_batch(self, tmp_path):
+        import importlib.util
+        import sqlite3
+        from pathlib import Path
+
+        script = Path(__file__).resolve().parents[2] / "work" / "scripts" / "extract_pst_to_sqlite.py"
+        spec = importlib.util.spec_from_file_location("extract_pst_to_sqlite", script)
+        extract = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(extract)
+
+        conn = sqlite3.connect(str(tmp_path / "mail.db"))
+        conn.executescript(extract.SCHEMA)
+        seen = extract.SeenHashes(extract.BlockedBloom(tmp_path / "mail.db.bloom", capacity=1000), conn)
+
+        # the same message twice in one PST batch, then once more in the next batch
+        emails, atts = [], []
+        for n, email_hash in enumerate(["h1", "h2", "h1"]):
+            if seen.check_and_add(email_hash):
+                continue
+            emails.append((email_hash, "", "s", "[]", "[]", "[]", "[]", "", "", "Inbox", "a.pst", 1, "b", ""))
+            atts.append((email_hash, "f.pdf", f"path{n}", 10))
+
+        assert extract.write_batch(conn, "a.pst", emails, atts, 3) == (2, 2)
+        seen.new_batch()
+        assert seen.check_and_add("h1") is True
+        assert conn.execute("SELECT COUNT(*) FROM attachments WHERE email_id = 'h1'").fetchone()[0] == 1
@@ -1,13 +1,20 @@
 # extract_pst_to_sqlite_improved.py
 
 import json
+import mmap
+import multiprocessing
+import queue
 import sqlite3
+import struct
+import traceback
 import hashlib
 from pathlib import Path
 from email.parser import HeaderParser
 from email import policy
 from email.utils import getaddresses, parsedate_to_datetime
+from concurrent.futures import ProcessPoolExecutor
 from datetime import timezone, datetime
+from functools import lru_cache
 from tqdm import tqdm
 
 
@@ -17,6 +24,20 @@ DB_PATH = r"E:\outlook\mail_local.db"
 
 SAVE_ATTACHMENTS = True
 BATCH = 500
+# сколько PST разбирается параллельно (по одному процессу на файл)
+PST_WORKERS = 4
+# сколько готовых пачек может ждать писателя
+QUEUE_SIZE = 8
+# продолжать с места остановки по таблице pst_progress
+RESUME = True
+# маркер прогресса сдвигается не реже, чем раз в столько сообщений PST
+PROGRESS_EVERY = 5000
+# дедуп по email_hash: блочный фильтр Блума в файле рядом с базой
+BLOOM_PATH = DB_PATH + ".bloom"
+BLOOM_CAPACITY = 50_000_000      # писем, на которые рассчитан фильтр (~60 МБ на диске)
+BLOOM_BITS_PER_ITEM = 10         # ~1% ложных срабатываний при заполнении до BLOOM_CAPACITY
+# записей в кэше каждого декодера заголовков
+HEADER_CACHE_SIZE = 65536
 
 
 # папки которые не хотим индексировать
@@ -31,16 +52,16 @@ def ensure_dir(p: Path):
     p.mkdir(parents=True, exist_ok=True)
 
 
-def parse_addrs(v):
-    if not v:
-        return []
-    return [addr for _, addr in getaddresses([v]) if addr]
+# From/To/Date в больших архивах повторяются, поэтому разбор кэшируется
 
 
-def parse_date_utc(v):
-    if not v:
-        return datetime(1970, 1, 1, tzinfo=timezone.utc)
+@lru_cache(maxsize=HEADER_CACHE_SIZE)
+def _parse_addrs(v: str):
+    return tuple(addr for _, addr in getaddresses([v]) if addr)
 
+
+@lru_cache(maxsize=HEADER_CACHE_SIZE)
+def _parse_date_utc(v: str):
     try:
         dt = parsedate_to_datetime(v)
         if dt.tzinfo is None:
@@ -52,6 +73,28 @@ def parse_date_utc(v):
         return datetime(1970, 1, 1, tzinfo=timezone.utc)
 
 
+def parse_addrs(v):
+    if not v:
+        return []
+    return list(_parse_addrs(str(v)))
+
+
+def parse_date_utc(v):
+    if not v:
+        return datetime(1970, 1, 1, tzinfo=timezone.utc)
+    return _parse_date_utc(str(v))
+
+
+def header_cache_summary():
+    parts = []
+    for name, cached in (("parse_addrs", _parse_addrs), ("parse_date", _parse_date_utc)):
+        info = cached.cache_info()
+        total = info.hits + info.misses
+        rate = 100.0 * info.hits / total if total else 0.0
+        parts.append(f"{name}={rate:.1f}% ({info.hits}/{total})")
+    return "header cache hit rate: " + ", ".join(parts)
+
+
 def is_probably_chat(body_text: str):
 
     if not body_text:
@@ -78,194 +121,523 @@ def compute_email_hash(message_id, subject, from_addr, sent_at, body):
     ).hexdigest()
 
 
-def main():
+SCHEMA = """
+PRAGMA journal_mode=WAL;
 
-    from libratom.lib.core import open_mail_archive
+CREATE TABLE IF NOT EXISTS emails(
+  id TEXT PRIMARY KEY,
+  message_id TEXT,
+  subject TEXT,
+  from_addr_json TEXT,
+  to_addr_json TEXT,
+  cc_addr_json TEXT,
+  bcc_addr_json TEXT,
+  sent_at_utc TEXT,
+  sent_at_raw TEXT,
+  folder TEXT,
+  source_pst TEXT,
+  body_len INTEGER,
+  body_text TEXT,
+  body_html TEXT
+);
 
-    ensure_dir(Path(ATTACH_DIR))
+CREATE TABLE IF NOT EXISTS attachments(
+  email_id TEXT,
+  filename TEXT,
+  path TEXT,
+  size_bytes INTEGER
+);
 
-    conn = sqlite3.connect(DB_PATH)
+CREATE INDEX IF NOT EXISTS idx_emails_sent
+ON emails(sent_at_utc);
+
+-- маркеры возобновления: сколько сообщений PST уже записано
+CREATE TABLE IF NOT EXISTS pst_progress(
+  source_pst TEXT PRIMARY KEY,
+  messages_done INTEGER NOT NULL,
+  done INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+
+def message_row(msg, pst: Path, header_parser):
+    """Строка emails для одного сообщения или None, если оно отфильтровано."""
+
+    th = msg.transport_headers or ""
+    h = header_parser.parsestr(th)
+
+    mid = (h.get("Message-ID") or h.get("Message-Id") or "").strip()
+
+    subj = (h.get("Subject") or "").strip()
+
+    from_ = parse_addrs(h.get("From"))
+    to_ = parse_addrs(h.get("To"))
+    cc_ = parse_addrs(h.get("Cc"))
+    bcc_ = parse_addrs(h.get("Bcc"))
+
+    rawdt = h.get("Date") or ""
+    dt_utc = parse_date_utc(rawdt)
+
+    body_text = getattr(msg, "plain_text_body", None) or ""
+    body_html = getattr(msg, "html_body", None) or ""
+
+    folder = getattr(msg, "folder_name", None) or "unknown"
+
+    # фильтр системных папок
+    if folder.lower() in IGNORE_FOLDERS:
+        return None
+
+    # фильтр чат сообщений
+    if is_probably_chat(body_text):
+        return None
+
+    body_len = len(body_text)
+
+    email_hash = compute_email_hash(
+        mid,
+        subj,
+        ",".join(from_),
+        rawdt,
+        body_text
+    )
+
+    email_row = (
+
+        email_hash,
+        mid,
+        subj,
+
+        json.dumps(from_, ensure_ascii=False),
+        json.dumps(to_, ensure_ascii=False),
+        json.dumps(cc_, ensure_ascii=False),
+        json.dumps(bcc_, ensure_ascii=False),
+
+        dt_utc.isoformat(),
+        rawdt,
+        folder,
+
+        pst.name,
+
+        body_len,
+        body_text,
+        body_html
+    )
+
+    return email_row
+
+
+def attachment_rows(msg, pst: Path, email_hash: str):
+    """Сохраняет вложения сообщения на диск и возвращает строки attachments."""
+
+    att_rows = []
+
+    for att in getattr(msg, "attachments", []):
+
+        fname = (att.name or f"att_{att.identifier}") \
+            .replace("\\", "_") \
+            .replace("/", "_")
+
+        size = int(getattr(att, "size", 0) or 0)
+
+        fpath = ""
+
+        if SAVE_ATTACHMENTS:
+
+            try:
+
+                data = att.read_buffer(size) if size else att.read()
+
+                dest = Path(ATTACH_DIR) / pst.stem / str(msg.identifier)
+
+                ensure_dir(dest)
+
+                fp = dest / fname
+
+                fp.write_bytes(data or b"")
 
-    conn.executescript("""
-    PRAGMA journal_mode=WAL;
-
-    CREATE TABLE IF NOT EXISTS emails(
-      id TEXT PRIMARY KEY,
-      message_id TEXT,
-      subject TEXT,
-      from_addr_json TEXT,
-      to_addr_json TEXT,
-      cc_addr_json TEXT,
-      bcc_addr_json TEXT,
-      sent_at_utc TEXT,
-      sent_at_raw TEXT,
-      folder TEXT,
-      source_pst TEXT,
-      body_len INTEGER,
-      body_text TEXT,
-      body_html TEXT
-    );
-
-    CREATE TABLE IF NOT EXISTS attachments(
-      email_id TEXT,
-      filename TEXT,
-      path TEXT,
-      size_bytes INTEGER
-    );
-
-    CREATE INDEX IF NOT EXISTS idx_emails_sent
-    ON emails(sent_at_utc);
-    """)
+                fpath = str(fp)
 
+            except Exception:
+                pass
+
+        att_rows.append((email_hash, fname, fpath, size))
+
+    return att_rows
+
+
+# =========================================================
+# дедуп: фильтр Блума на диске + точная проверка по SQLite
+# =========================================================
+
+class BlockedBloom:
+    """Блочный фильтр Блума в файле, отображённом через mmap.
+
+    Все k битов ключа лежат в одном 64-байтном блоке (одна строка кэша),
+    поэтому проверка стоит одного обращения к памяти, а резидентной
+    становится только горячая часть файла. Файл переживает перезапуски.
+
+    Фильтр даёт только "точно нет" / "возможно да": положительный ответ
+    подтверждается по первичному ключу emails (см. SeenHashes).
+    """
+
+    MAGIC = b"PSTBLM01"
+    HEADER = struct.Struct("<8sQQ")  # magic, n_blocks, k
+    BLOCK_BYTES = 64
+    BLOCK_BITS = BLOCK_BYTES * 8
+
+    def __init__(self, path, capacity=BLOOM_CAPACITY, bits_per_item=BLOOM_BITS_PER_ITEM):
+        self.path = Path(path)
+        self.created = not self.path.exists()
+
+        if self.created:
+            n_blocks = max(1, capacity * bits_per_item // self.BLOCK_BITS)
+            # k ≈ ln2 * bits_per_item; 7 позиций по 9 бит помещаются в 64 бита хэша
+            k = max(1, min(7, round(bits_per_item * 0.693)))
+            with open(self.path, "wb") as f:
+                f.write(self.HEADER.pack(self.MAGIC, n_blocks, k))
+                f.truncate(self.HEADER.size + n_blocks * self.BLOCK_BYTES)
+
+        self.file = open(self.path, "r+b")
+        self.mm = mmap.mmap(self.file.fileno(), 0)
+
+        magic, self.n_blocks, self.k = self.HEADER.unpack_from(self.mm, 0)
+        if magic != self.MAGIC:
+            raise ValueError(f"{self.path}: не файл фильтра Блума")
+
+    def _positions(self, key: str):
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+
+        base = self.HEADER.size + (int.from_bytes(digest[:8], "little") % self.n_blocks) * self.BLOCK_BYTES
+        bits = int.from_bytes(digest[8:], "little")
+
+        for _ in range(self.k):
+            bit = bits & (self.BLOCK_BITS - 1)
+            bits >>= 9
+            yield base + (bit >> 3), 1 << (bit & 7)
+
+    def might_contain(self, key: str) -> bool:
+        mm = self.mm
+        return all(mm[offset] & mask for offset, mask in self._positions(key))
+
+    def add(self, key: str):
+        # Гонки между процессами на одном байте могут потерять бит — это лишь
+        # пропущенный дубль, который потом отсеет INSERT OR IGNORE.
+        mm = self.mm
+        for offset, mask in self._positions(key):
+            mm[offset] |= mask
+
+    def flush(self):
+        self.mm.flush()
+
+    def close(self):
+        self.mm.flush()
+        self.mm.close()
+        self.file.close()
+
+
+class SeenHashes:
+    """Множество уже извлечённых email_hash с ограниченной памятью.
+
+    "Возможно да" от фильтра Блума подтверждается точным запросом по
+    первичному ключу emails. Хэши текущей, ещё не отправленной пачки
+    хранятся в памяти: база их не подтвердит, а дубль внутри пачки
+    иначе получил бы вторую копию вложений. Хэши, которые воркер уже
+    отправил, но писатель ещё не закоммитил, база тоже не подтвердит —
+    такие дубли досеет INSERT OR IGNORE у писателя.
+    """
+
+    def __init__(self, bloom: BlockedBloom, conn):
+        self.bloom = bloom
+        self.conn = conn
+        self.batch = set()
+        self.bloom_hits = 0
+        self.confirmed = 0
+
+    def new_batch(self):
+        """Пачка отправлена писателю: её хэши больше не держим в памяти."""
+        self.batch.clear()
+
+    def check_and_add(self, email_hash: str) -> bool:
+        """True, если письмо уже есть в базе или в текущей пачке; иначе запоминает хэш."""
+        if email_hash in self.batch:
+            self.confirmed += 1
+            return True
+        self.batch.add(email_hash)
+
+        if self.bloom.might_contain(email_hash):
+            self.bloom_hits += 1
+            row = self.conn.execute("SELECT 1 FROM emails WHERE id = ?", (email_hash,)).fetchone()
+            if row:
+                self.confirmed += 1
+                return True
+        else:
+            self.bloom.add(email_hash)
+        return False
+
+
+def build_bloom(conn) -> BlockedBloom:
+    """Открывает фильтр; новый файл заполняется id уже извлечённых писем."""
+    bloom = BlockedBloom(BLOOM_PATH)
+
+    if bloom.created:
+        n = 0
+        for (email_id,) in conn.execute("SELECT id FROM emails"):
+            bloom.add(email_id)
+            n += 1
+        bloom.flush()
+        if n:
+            print(f"Фильтр Блума {BLOOM_PATH}: добавлено {n} известных писем")
+
+    return bloom
+
+
+# =========================================================
+# воркер: один процесс на PST
+# =========================================================
+
+_rows_queue = None
+
+
+def _init_worker(rows_queue):
+    global _rows_queue
+    _rows_queue = rows_queue
+
+
+def extract_pst(pst_path: str, skip: int):
+    """Разбирает один PST и отправляет пачки строк писателю.
+
+    Первые skip сообщений уже записаны прошлым запуском и пропускаются.
+    Каждая пачка несёт число просмотренных сообщений (вместе с
+    отфильтрованными) — писатель сохраняет его как маркер возобновления.
+    """
+
+    from libratom.lib.core import open_mail_archive
+
+    pst = Path(pst_path)
     header_parser = HeaderParser(policy=policy.default)
 
     emails_buf = []
     atts_buf = []
 
-    seen_hashes = set()
+    # дедуп по всем PST и прошлым запускам без хранения хэшей в памяти
+    bloom = BlockedBloom(BLOOM_PATH)
+    seen_conn = sqlite3.connect(DB_PATH, timeout=60)
+    seen = SeenHashes(bloom, seen_conn)
 
-    def flush():
-        nonlocal emails_buf, atts_buf
+    consumed = skip
+    sent = skip
 
-        if emails_buf:
-            conn.executemany("""
-            INSERT OR IGNORE INTO emails
-            (id,message_id,subject,from_addr_json,to_addr_json,cc_addr_json,bcc_addr_json,
-             sent_at_utc,sent_at_raw,folder,source_pst,body_len,body_text,body_html)
-            VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?)
-            """, emails_buf)
+    def send():
+        nonlocal emails_buf, atts_buf, sent
+        _rows_queue.put(("batch", pst.name, emails_buf, atts_buf, consumed))
+        seen.new_batch()
+        emails_buf = []
+        atts_buf = []
+        sent = consumed
 
-            emails_buf = []
+    try:
+        with open_mail_archive(pst) as arc:
 
-        if atts_buf:
-            conn.executemany("""
-            INSERT INTO attachments
-            (email_id,filename,path,size_bytes)
-            VALUES (?,?,?,?)
-            """, atts_buf)
+            for i, msg in enumerate(arc.messages()):
 
-            atts_buf = []
+                if i < skip:
+                    continue
 
-        conn.commit()
+                # длинные серии отфильтрованных писем тоже должны двигать маркер
+                if consumed - sent >= PROGRESS_EVERY:
+                    send()
 
+                consumed = i + 1
 
-    pst_files = list(Path(PST_DIR).rglob("*.pst"))
+                email_row = message_row(msg, pst, header_parser)
+                if email_row is None:
+                    continue
 
-    for pst in pst_files:
+                # известное письмо: ни строк, ни вложений на диск
+                if seen.check_and_add(email_row[0]):
+                    continue
 
-        print(f"\nPST: {pst}")
+                emails_buf.append(email_row)
+                atts_buf.extend(attachment_rows(msg, pst, email_row[0]))
 
-        with open_mail_archive(pst) as arc:
+                if len(emails_buf) >= BATCH or len(atts_buf) >= BATCH:
+                    send()
 
-            for msg in tqdm(arc.messages(), desc=pst.name):
+        send()
+        _rows_queue.put((
+            "done", pst.name, consumed,
+            f"known={seen.confirmed}, bloom_unconfirmed={seen.bloom_hits - seen.confirmed}; "
+            + header_cache_summary()
+        ))
 
-                th = msg.transport_headers or ""
-                h = header_parser.parsestr(th)
+    except Exception:
+        _rows_queue.put(("error", pst.name, traceback.format_exc()))
 
-                mid = (h.get("Message-ID") or h.get("Message-Id") or "").strip()
+    finally:
+        seen_conn.close()
+        bloom.close()
 
-                subj = (h.get("Subject") or "").strip()
 
-                from_ = parse_addrs(h.get("From"))
-                to_ = parse_addrs(h.get("To"))
-                cc_ = parse_addrs(h.get("Cc"))
-                bcc_ = parse_addrs(h.get("Bcc"))
+# =========================================================
+# писатель: единственное соединение с SQLite
+# =========================================================
 
-                rawdt = h.get("Date") or ""
-                dt_utc = parse_date_utc(rawdt)
+def load_progress(conn):
+    if not RESUME:
+        conn.execute("DELETE FROM pst_progress")
+        conn.commit()
+        return {}
 
-                body_text = getattr(msg, "plain_text_body", None) or ""
-                body_html = getattr(msg, "html_body", None) or ""
+    return {
+        name: (messages_done, bool(done))
+        for name, messages_done, done in conn.execute(
+            "SELECT source_pst, messages_done, done FROM pst_progress"
+        )
+    }
 
-                folder = getattr(msg, "folder_name", None) or "unknown"
 
-                # фильтр системных папок
-                if folder.lower() in IGNORE_FOLDERS:
-                    continue
+def write_batch(conn, pst_name, emails, atts, consumed):
+    """Пишет пачку и маркер прогресса одной транзакцией. Возвращает (emails, attachments)."""
 
-                # фильтр чат сообщений
-                if is_probably_chat(body_text):
-                    continue
+    inserted = set()
 
-                body_len = len(body_text)
+    for row in emails:
+        cur = conn.execute("""
+        INSERT OR IGNORE INTO emails
+        (id,message_id,subject,from_addr_json,to_addr_json,cc_addr_json,bcc_addr_json,
+         sent_at_utc,sent_at_raw,folder,source_pst,body_len,body_text,body_html)
+        VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?)
+        """, row)
 
-                email_hash = compute_email_hash(
-                    mid,
-                    subj,
-                    ",".join(from_),
-                    rawdt,
-                    body_text
-                )
+        if cur.rowcount:
+            inserted.add(row[0])
 
-                # дедуп в памяти
-                if email_hash in seen_hashes:
-                    continue
+    # вложения дублей (письмо уже есть из другого PST или прошлого запуска) не пишем
+    atts = [a for a in atts if a[0] in inserted]
+
+    if atts:
+        conn.executemany("""
+        INSERT INTO attachments
+        (email_id,filename,path,size_bytes)
+        VALUES (?,?,?,?)
+        """, atts)
+
+    conn.execute("""
+    INSERT INTO pst_progress (source_pst, messages_done, done) VALUES (?, ?, 0)
+    ON CONFLICT(source_pst) DO UPDATE SET messages_done = excluded.messages_done
+    """, (pst_name, consumed))
 
-                seen_hashes.add(email_hash)
+    conn.commit()
 
-                emails_buf.append((
+    return len(inserted), len(atts)
 
-                    email_hash,
-                    mid,
-                    subj,
 
-                    json.dumps(from_, ensure_ascii=False),
-                    json.dumps(to_, ensure_ascii=False),
-                    json.dumps(cc_, ensure_ascii=False),
-                    json.dumps(bcc_, ensure_ascii=False),
+def main():
 
-                    dt_utc.isoformat(),
-                    rawdt,
-                    folder,
+    ensure_dir(Path(ATTACH_DIR))
 
-                    pst.name,
+    conn = sqlite3.connect(DB_PATH)
+    conn.executescript(SCHEMA)
 
-                    body_len,
-                    body_text,
-                    body_html
-                ))
+    progress = load_progress(conn)
 
-                # вложения
-                for att in getattr(msg, "attachments", []):
+    # создаётся до воркеров: они только открывают готовый файл
+    build_bloom(conn).close()
 
-                    fname = (att.name or f"att_{att.identifier}") \
-                        .replace("\\", "_") \
-                        .replace("/", "_")
+    jobs = []
 
-                    size = int(getattr(att, "size", 0) or 0)
+    for pst in Path(PST_DIR).rglob("*.pst"):
 
-                    fpath = ""
+        skip, done = progress.get(pst.name, (0, False))
 
-                    if SAVE_ATTACHMENTS:
+        if done:
+            print(f"PST: {pst} — уже загружен, пропуск")
+            continue
 
-                        try:
+        if skip:
+            print(f"PST: {pst} — продолжаем с сообщения {skip}")
 
-                            data = att.read_buffer(size) if size else att.read()
+        jobs.append((pst, skip))
 
-                            dest = Path(ATTACH_DIR) / pst.stem / str(msg.identifier)
+    # крупные PST первыми, чтобы последний воркер не досчитывал гиганта в одиночку
+    jobs.sort(key=lambda job: job[0].stat().st_size, reverse=True)
 
-                            ensure_dir(dest)
+    rows_queue = multiprocessing.Queue(maxsize=QUEUE_SIZE)
 
-                            fp = dest / fname
+    totals = {}
+    errors = []
 
-                            fp.write_bytes(data or b"")
+    with ProcessPoolExecutor(
+        max_workers=max(1, min(PST_WORKERS, len(jobs) or 1)),
+        initializer=_init_worker,
+        initargs=(rows_queue,),
+    ) as pool:
 
-                            fpath = str(fp)
+        futures = [pool.submit(extract_pst, str(pst), skip) for pst, skip in jobs]
 
-                        except Exception:
-                            pass
+        remaining = len(futures)
 
-                    atts_buf.append((email_hash, fname, fpath, size))
+        with tqdm(unit="msg", desc="pst") as bar:
 
-                if len(emails_buf) >= BATCH or len(atts_buf) >= BATCH:
-                    flush()
+            while remaining:
 
-    flush()
+                try:
+                    item = rows_queue.get(timeout=5)
+                except queue.Empty:
+                    # воркер мог упасть целиком (например, убит по памяти)
+                    if all(f.done() for f in futures):
+                        for f in futures:
+                            if f.exception() is not None:
+                                errors.append(("?", repr(f.exception())))
+                        break
+                    continue
+
+                kind, pst_name = item[0], item[1]
+                stats = totals.setdefault(pst_name, {
+                    "messages": progress.get(pst_name, (0, False))[0],
+                    "emails": 0,
+                    "attachments": 0,
+                })
+
+                if kind == "batch":
+                    _, _, emails, atts, consumed = item
+
+                    n_emails, n_atts = write_batch(conn, pst_name, emails, atts, consumed)
+
+                    bar.update(consumed - stats["messages"])
+                    stats["messages"] = consumed
+                    stats["emails"] += n_emails
+                    stats["attachments"] += n_atts
+                    bar.set_postfix_str(f"{pst_name}: {consumed}")
+
+                elif kind == "done":
+                    _, _, consumed, summary = item
+
+                    conn.execute("""
+                    INSERT INTO pst_progress (source_pst, messages_done, done) VALUES (?, ?, 1)
+                    ON CONFLICT(source_pst) DO UPDATE SET messages_done = excluded.messages_done, done = 1
+                    """, (pst_name, consumed))
+                    conn.commit()
+
+                    remaining -= 1
+                    tqdm.write(
+                        f"PST: {pst_name} — готово: messages={consumed}, "
+                        f"emails={stats['emails']}, attachments={stats['attachments']}, {summary}"
+                    )
+
+                else:
+                    _, _, error = item
+                    remaining -= 1
+                    errors.append((pst_name, error))
+                    tqdm.write(f"PST: {pst_name} — ошибка, прогресс сохранён:\n{error}")
 
     conn.close()
 
     print(f"\nГотово. SQLite: {DB_PATH}")
 
+    if errors:
+        raise SystemExit(f"Ошибки в {len(errors)} PST, перезапустите скрипт для продолжения")
+
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,8 +1,14 @@
 # upload_sqlite_to_clickhouse.py
-import os, json, sqlite3
+import os, json, sqlite3, sys, threading, time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timezone
+from pathlib import Path
 import clickhouse_connect
 
+# общий хелпер колоночных вставок из project/
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / "project"))
+from ch_insert import InsertStats, bulk_insert  # noqa: E402
+
 # ===== Настройки =====
 SQLITE_DB = r"E:\outlook\mail_local.db"
 
@@ -14,6 +20,17 @@ CH_DB   = 'mailkb'
 
 BATCH = 1000
 MAX_ROWS = int(os.getenv('MAX_ROWS', '0'))  # 0 = грузить все
+ASYNC_INSERT = os.getenv('CH_ASYNC_INSERT', 'false').lower() == 'true'
+WORKERS = int(os.getenv('UPLOAD_WORKERS', '4'))  # параллельные читатели/загрузчики
+RESUME = os.getenv('RESUME', 'true').lower() == 'true'  # продолжать с последнего rowid
+
+EMAIL_COLUMNS = [
+    "id","message_id","subject",
+    "from_addr","to_addr","cc_addr","bcc_addr",
+    "sent_at_utc","sent_at_raw","folder",
+    "body_text","body_html",
+]
+ATTACH_COLUMNS = ["email_id","filename","path","size_bytes"]
 
 # ===== Утилиты нормализации =====
 def to_text(x):
@@ -55,113 +72,226 @@ def parse_dt(s: str):
     except Exception:
         return datetime(1970, 1, 1, tzinfo=timezone.utc)
 
+EMAILS_SELECT = """
+    SELECT rowid, id, message_id, subject,
+           from_addr_json, to_addr_json, cc_addr_json, bcc_addr_json,
+           sent_at_utc, sent_at_raw, folder, body_text, body_html
+    FROM emails
+    WHERE rowid > ? AND rowid <= ?
+    ORDER BY rowid
+    LIMIT ?
+"""
+
+ATTACH_SELECT = """
+    SELECT rowid, email_id, filename, path, size_bytes
+    FROM attachments
+    WHERE rowid > ? AND rowid <= ?
+    ORDER BY rowid
+    LIMIT ?
+"""
+
+
+def email_payload(r):
+    # JSON массивы адресов -> list[str]
+    return [
+        to_text(r[0]),                                  # id
+        to_text(r[1]),                                  # message_id
+        to_text(r[2]),                                  # subject
+        to_str_list(json.loads(r[3] or "[]")),          # from_addr Array(String)
+        to_str_list(json.loads(r[4] or "[]")),          # to_addr
+        to_str_list(json.loads(r[5] or "[]")),          # cc_addr
+        to_str_list(json.loads(r[6] or "[]")),          # bcc_addr
+        parse_dt(to_text(r[7])),                        # sent_at_utc
+        to_text(r[8]),                                  # sent_at_raw
+        to_text(r[9]),                                  # folder
+        to_text(r[10]),                                 # body_text  (bytes -> str)
+        to_text(r[11]),                                 # body_html  (bytes -> str)
+    ]
+
+
+def attach_payload(r):
+    # нормализуем строковые поля вложений на всякий
+    return [to_text(r[0]), to_text(r[1]), to_text(r[2]), int(r[3] or 0)]
+
+
+# table -> (SELECT, нормализация строки, таблица ClickHouse, колонки)
+TABLES = {
+    "emails": (EMAILS_SELECT, email_payload, "mailkb.emails", EMAIL_COLUMNS),
+    "attachments": (ATTACH_SELECT, attach_payload, "mailkb.attachments", ATTACH_COLUMNS),
+}
+
+
+# ===== Прогресс / возобновление =====
+def open_sqlite():
+    return sqlite3.connect(SQLITE_DB, timeout=60, check_same_thread=False)
+
+
+def ensure_progress_table(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS upload_progress(
+          tbl TEXT,
+          range_start INTEGER,
+          range_end INTEGER,
+          committed_rowid INTEGER,
+          PRIMARY KEY (tbl, range_start)
+        )
+    """)
+    conn.commit()
+
+
+def last_rowid(conn, table):
+    """Верхняя граница загрузки: последний rowid или rowid строки номер MAX_ROWS."""
+    if MAX_ROWS:
+        row = conn.execute(
+            f"SELECT rowid FROM {table} ORDER BY rowid LIMIT 1 OFFSET ?", (MAX_ROWS - 1,)
+        ).fetchone()
+        if row:
+            return row[0]
+    return conn.execute(f"SELECT COALESCE(MAX(rowid), 0) FROM {table}").fetchone()[0]
+
+
+def plan_ranges(conn, table):
+    """Непересекающиеся диапазоны rowid (start, end], по одному на воркер.
+
+    Уже сохранённые диапазоны берутся из upload_progress как есть; если в
+    таблице появились новые строки, для хвоста заводятся новые диапазоны.
+    Возвращает [(range_start, committed_rowid, range_end)] с недогруженными.
+    """
+    if not RESUME:
+        conn.execute("DELETE FROM upload_progress WHERE tbl = ?", (table,))
+        conn.commit()
+
+    rows = conn.execute(
+        "SELECT range_start, range_end, committed_rowid FROM upload_progress WHERE tbl = ? ORDER BY range_start",
+        (table,)
+    ).fetchall()
+
+    covered = max((r[1] for r in rows), default=0)
+    hi = last_rowid(conn, table)
+
+    if hi > covered:
+        step = max(1, -(-(hi - covered) // max(1, WORKERS)))
+        for start in range(covered, hi, step):
+            end = min(start + step, hi)
+            conn.execute(
+                "INSERT INTO upload_progress (tbl, range_start, range_end, committed_rowid) VALUES (?, ?, ?, ?)",
+                (table, start, end, start)
+            )
+            rows.append((start, end, start))
+        conn.commit()
+
+    return [(start, committed, end) for start, end, committed in rows if committed < end]
+
+
+def count_rows(conn, table, ranges):
+    return sum(
+        conn.execute(
+            f"SELECT COUNT(*) FROM {table} WHERE rowid > ? AND rowid <= ?", (committed, end)
+        ).fetchone()[0]
+        for _, committed, end in ranges
+    )
+
+
+class Progress:
+    def __init__(self, table, total):
+        self.table = table
+        self.total = total
+        self.rows = 0
+        self.bytes = 0
+        self.started = time.time()
+        self.lock = threading.Lock()
+
+    def add(self, rows, nbytes):
+        with self.lock:
+            self.rows += rows
+            self.bytes += nbytes
+            elapsed = max(time.time() - self.started, 1e-6)
+            print(
+                f"Загружено {self.table}: {self.rows}/{self.total}, "
+                f"{self.bytes / (1024 * 1024) / elapsed:.2f} MB/s, {self.rows / elapsed:.0f} rows/s"
+            )
+
+
+def upload_range(client_factory, table, range_start, committed, range_end, stats, progress):
+    """Читает (committed, range_end] страницами по rowid и грузит в ClickHouse.
+
+    После каждой вставки committed_rowid сдвигается на последний загруженный
+    rowid, так что перезапуск продолжает ровно с него.
+    """
+    select, payload_fn, ch_table, columns = TABLES[table]
+    client = client_factory()
+    conn = open_sqlite()
+
+    try:
+        while committed < range_end:
+            rows = conn.execute(select, (committed, range_end, BATCH)).fetchall()
+            if not rows:
+                committed = range_end
+            else:
+                payload = [payload_fn(r[1:]) for r in rows]
+                # свой счётчик на вставку: общий stats двигают и другие потоки
+                batch_stats = InsertStats()
+                bulk_insert(client, ch_table, payload, columns,
+                            async_insert=ASYNC_INSERT, stats=batch_stats)
+                stats.merge(batch_stats.as_dict())
+                committed = rows[-1][0]
+                progress.add(len(rows), batch_stats.bytes)
+
+            conn.execute(
+                "UPDATE upload_progress SET committed_rowid = ? WHERE tbl = ? AND range_start = ?",
+                (committed, table, range_start)
+            )
+            conn.commit()
+    finally:
+        conn.close()
+
+
+def upload_table(client_factory, table, stats):
+    conn = open_sqlite()
+    ranges = plan_ranges(conn, table)
+    total = count_rows(conn, table, ranges)
+    conn.close()
+
+    print(f"{table}: к загрузке {total} строк, диапазонов rowid: {len(ranges)}, воркеров: {WORKERS}")
+    if not ranges:
+        return
+
+    progress = Progress(table, total)
+    with ThreadPoolExecutor(max_workers=max(1, WORKERS)) as pool:
+        futures = [
+            pool.submit(upload_range, client_factory, table, start, committed, end, stats, progress)
+            for start, committed, end in ranges
+        ]
+        for f in as_completed(futures):
+            f.result()
+
+
 # ===== Основной код =====
 def main():
     print(f"Connecting to ClickHouse http://{CH_HOST}:{CH_PORT} as {CH_USER}, db={CH_DB}")
-    client = clickhouse_connect.get_client(
-        host=CH_HOST, port=CH_PORT, username=CH_USER, password=CH_PASS, database=CH_DB
-    )
-    # быстрый пинг
-    ver = client.query('SELECT version()').result_rows[0][0]
-    print("Server version:", ver)
 
-    conn = sqlite3.connect(SQLITE_DB)
-    cur = conn.cursor()
-
-    # ---- emails ----
-    cur.execute("SELECT COUNT(*) FROM emails")
-    total = cur.fetchone()[0]
-    if MAX_ROWS and MAX_ROWS < total:
-        print(f"Всего писем в SQLite: {total}. Загрузим только первые {MAX_ROWS} (MAX_ROWS).")
-        total = MAX_ROWS
-    else:
-        print("Всего писем к загрузке:", total)
-
-    offs = 0
-    while offs < total:
-        limit = min(BATCH, total - offs)
-        cur.execute("""
-            SELECT id, message_id, subject,
-                   from_addr_json, to_addr_json, cc_addr_json, bcc_addr_json,
-                   sent_at_utc, sent_at_raw, folder, body_text, body_html
-            FROM emails
-            ORDER BY rowid
-            LIMIT ? OFFSET ?
-        """, (limit, offs))
-        rows = cur.fetchall()
-        if not rows:
-            break
-        offs += len(rows)
-
-        payload = []
-        for r in rows:
-            # JSON массивы адресов -> list[str]
-            from_addrs = to_str_list(json.loads(r[3] or "[]"))
-            to_addrs   = to_str_list(json.loads(r[4] or "[]"))
-            cc_addrs   = to_str_list(json.loads(r[5] or "[]"))
-            bcc_addrs  = to_str_list(json.loads(r[6] or "[]"))
-
-            payload.append([
-                to_text(r[0]),                 # id
-                to_text(r[1]),                 # message_id
-                to_text(r[2]),                 # subject
-                from_addrs,                    # from_addr Array(String)
-                to_addrs,                      # to_addr
-                cc_addrs,                      # cc_addr
-                bcc_addrs,                     # bcc_addr
-                parse_dt(to_text(r[7])),       # sent_at_utc
-                to_text(r[8]),                 # sent_at_raw
-                to_text(r[9]),                 # folder
-                to_text(r[10]),                # body_text  (bytes -> str)
-                to_text(r[11]),                # body_html  (bytes -> str)
-            ])
-
-        client.insert(
-            "mailkb.emails",
-            payload,
-            column_names=[
-                "id","message_id","subject",
-                "from_addr","to_addr","cc_addr","bcc_addr",
-                "sent_at_utc","sent_at_raw","folder",
-                "body_text","body_html",
-            ],
-        )
-        print(f"Загружено писем: {offs}/{total}")
-
-    # ---- attachments ----
-    cur.execute("SELECT COUNT(*) FROM attachments")
-    total_a = cur.fetchone()[0]
-    if MAX_ROWS and MAX_ROWS < total_a:
-        print(f"Всего вложений в SQLite: {total_a}. Загрузим только первые {MAX_ROWS} (MAX_ROWS).")
-        total_a = MAX_ROWS
-    else:
-        print("Всего вложений к загрузке:", total_a)
-
-    offs = 0
-    while offs < total_a:
-        limit = min(BATCH, total_a - offs)
-        cur.execute("""
-            SELECT email_id, filename, path, size_bytes
-            FROM attachments
-            ORDER BY rowid
-            LIMIT ? OFFSET ?
-        """, (limit, offs))
-        rows = cur.fetchall()
-        if not rows:
-            break
-        offs += len(rows)
-
-        # нормализуем строковые поля вложений на всякий
-        rows_norm = [[to_text(r[0]), to_text(r[1]), to_text(r[2]), int(r[3] or 0)] for r in rows]
-
-        client.insert(
-            "mailkb.attachments",
-            rows_norm,
-            column_names=["email_id","filename","path","size_bytes"],
+    def client_factory():
+        # у каждого воркера свой клиент: сессия clickhouse-connect не допускает параллельных запросов
+        return clickhouse_connect.get_client(
+            host=CH_HOST, port=CH_PORT, username=CH_USER, password=CH_PASS, database=CH_DB
         )
-        print(f"Загружено вложений: {offs}/{total_a}")
 
+    # быстрый пинг
+    ver = client_factory().query('SELECT version()').result_rows[0][0]
+    print("Server version:", ver)
+
+    conn = open_sqlite()
+    ensure_progress_table(conn)
     conn.close()
+
+    stats = InsertStats()
+    started = time.time()
+
+    for table in TABLES:
+        upload_table(client_factory, table, stats)
+
+    elapsed = max(time.time() - started, 1e-6)
+    print(stats.summary(), f"elapsed={elapsed:.1f}s, MB/s={stats.bytes / (1024 * 1024) / elapsed:.2f}")
     print("Готово.")
 
 if __name__ == "__main__":